@@ -0,0 +1,129 @@
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+from bvh import BVH
+from camera import Camera
+from ray_tracer import save_image
+from scene_loader import loadScene, parseGroup
+from tile_renderer import RenderContext, renderTile, splitTiles
+from utilities import hasIntersections, findTransparencyFactors
+
+# Values of a keyframe line of a camera path file:
+# key   time   px py pz   lx ly lz   ux uy uz   sc_dist   sc_width
+KEYFRAME_RECORD = 'key'
+KEYFRAME_COLUMNS = 12
+
+
+# Parse a camera path file into a (keyframes, 12) array sorted by time
+def parseCameraPath(file_path):
+    lines = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if not parts or parts[0].startswith("#"):
+                continue
+            if parts[0] != KEYFRAME_RECORD:
+                raise ValueError("Unknown object type: {}".format(parts[0]))
+            lines.append(parts[1] if len(parts) > 1 else "")
+
+    keyframes = parseGroup(lines, KEYFRAME_COLUMNS)
+    if len(keyframes) == 0:
+        raise ValueError("Camera path {} has no keyframes".format(file_path))
+    return keyframes[np.argsort(keyframes[:, 0], kind='stable')]
+
+
+# Cameras of the frames: the keyframes are linearly interpolated at frames evenly spaced from the first keyframe
+# time to the last
+def interpolateCameras(keyframes, frames):
+    times = np.linspace(keyframes[0, 0], keyframes[-1, 0], frames)
+    values = np.stack([np.interp(times, keyframes[:, 0], keyframes[:, column])
+                       for column in range(1, KEYFRAME_COLUMNS)], axis=1)
+    return [Camera(row[0:3], row[3:6], row[6:9], float(row[9]), float(row[10])) for row in values]
+
+
+# Render one frame with the given camera into a (height, width, 3) array of colors in [0, 255]
+def renderFrame(context, color_finder, camera, tile_size):
+    context.setCamera(camera)
+    image_array = np.zeros((context.getHeight(), context.getWidth(), 3))
+    for tile in splitTiles(context.getWidth(), context.getHeight(), tile_size):
+        x0, y0, x1, y1 = tile
+        image_array[y0:y1, x0:x1], _, _ = renderTile(context, color_finder, tile)
+    return image_array
+
+
+# State of a worker process: the scene is shipped once, every frame only sends its camera
+worker_context = None
+worker_color_finder = None
+
+
+def initAnimationWorker(context):
+    global worker_context, worker_color_finder
+    worker_context = context
+    worker_color_finder = context.createColorFinder()
+
+
+def renderWorkerFrame(job):
+    camera, output_image, tile_size = job
+    save_image(output_image, renderFrame(worker_context, worker_color_finder, camera, tile_size))
+    return output_image
+
+
+# Render all the frames, a whole frame per task, and write them to output_pattern (e.g. frames/frame_%04d.png)
+def renderAnimation(context, cameras, output_pattern, workers=1, tile_size=64):
+    jobs = [(camera, output_pattern % frame, tile_size) for frame, camera in enumerate(cameras)]
+    if workers <= 1:
+        initAnimationWorker(context)
+        for job in jobs:
+            yield renderWorkerFrame(job)
+        return
+
+    with multiprocessing.Pool(workers, initializer=initAnimationWorker, initargs=(context,)) as pool:
+        for output_image in pool.imap_unordered(renderWorkerFrame, jobs):
+            yield output_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Python Ray Tracer animation')
+    parser.add_argument('scene_file', type=str, help='Path to the scene file')
+    parser.add_argument('camera_path', type=str, help='Path to the camera path file (key lines)')
+    parser.add_argument('output_pattern', type=str, help='Pattern of the frame file names, e.g. frame_%%04d.png')
+    parser.add_argument('--frames', type=int, default=24, help='Number of frames')
+    parser.add_argument('--width', type=int, default=500, help='Image width')
+    parser.add_argument('--height', type=int, default=500, help='Image height')
+    parser.add_argument('-t', action='store_true', default=False, help='Consider transparency of objects in soft '
+                                                                       'shadow process')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes rendering frames in parallel')
+    parser.add_argument('--tile-size', type=int, default=64, help='Width and height of the rendered tiles')
+    parser.add_argument('--scene-cache', type=str, default=None, help='Directory of parsed scenes, keyed by the '
+                                                                       'hash of the scene file')
+    args = parser.parse_args()
+
+    print("Animation starts running")
+    start_time = time.time()
+
+    # Parse the scene and build the BVH once, all the frames share them
+    camera, scene_settings, surfaces, materials, lights, compiled_scene = loadScene(args.scene_file,
+                                                                                    args.scene_cache)
+    bvh = BVH(surfaces, compiled_scene)
+    cameras = interpolateCameras(parseCameraPath(args.camera_path), args.frames)
+
+    softshadow_func = findTransparencyFactors if args.t else hasIntersections
+    context = RenderContext(camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh,
+                            softshadow_func, args.width, args.height)
+
+    output_dir = os.path.dirname(args.output_pattern)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    for index, output_image in enumerate(renderAnimation(context, cameras, args.output_pattern, args.workers,
+                                                         args.tile_size)):
+        print("[{}/{}] {}".format(index + 1, len(cameras), output_image))
+
+    # Display time it Took
+    minutes = "{:.2f}".format((time.time() - start_time) / 60.0)
+    print("Finished, total time in minutes: " + str(minutes))
+
+
+if __name__ == '__main__':
+    main()
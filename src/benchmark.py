@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from bvh import BVH
+from ray_tracer import save_image
+from render_stats import RAY_COUNTERS, stats
+from scene_generator import generateScene
+from scene_loader import parseSceneRecords, buildScene
+from tile_renderer import RenderContext, renderImage
+from utilities import hasIntersections, findTransparencyFactors
+
+# resource only exists on Unix, elsewhere the peak memory is traced with tracemalloc
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Scene every sweep starts from, each sweep changes one of its parameters
+BENCHMARK_BASE = {'spheres': 100, 'boxes': 20, 'lights': 2, 'shadow_rays': 3, 'recursions': 3}
+
+
+# Peak resident memory of the process or of its largest finished child (render workers), whichever is larger, in
+# megabytes. The two peaks happen at different times, so adding them would overstate it. ru_maxrss is in bytes on
+# macOS and in kilobytes on the other Unix systems. Without resource it is the peak of the memory allocated by Python
+# (numpy arrays included) in this process only, traced since runCase started, and None if nothing was traced
+def findPeakMemory():
+    if resource is None:
+        if not tracemalloc.is_tracing():
+            return None
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak / 2 ** 20
+    return peak / 1024.0
+
+
+# Generate, render and save one scene, timing every stage. Runs in its own process so the peak memory is its own
+def runCase(case):
+    stage_times = {}
+    stats.collect()
+    if resource is None:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as directory:
+        scene_file = os.path.join(directory, 'scene.txt')
+        generateScene(scene_file, case['spheres'], case['boxes'], case['lights'], case['shadow_rays'],
+                      case['recursions'], case['seed'])
+
+        start_time = time.perf_counter()
+        records = parseSceneRecords(scene_file)
+        stage_times['parse'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        camera, scene_settings, surfaces, materials, lights, compiled_scene = buildScene(records)
+        stage_times['compile'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        bvh = BVH(surfaces, compiled_scene)
+        stage_times['bvh'] = time.perf_counter() - start_time
+
+        softshadow_func = findTransparencyFactors if case['transparency'] else hasIntersections
+        context = RenderContext(camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh,
+                                softshadow_func, case['width'], case['height'])
+        context.setWavefront(case['wavefront'])
+        start_time = time.perf_counter()
+        image_array, _ = renderImage(context, case['workers'], case['tile_size'])
+        stage_times['render'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        save_image(os.path.join(directory, 'image.png'), image_array)
+        stage_times['save'] = time.perf_counter() - start_time
+
+    primary_rays = case['width'] * case['height']
+    report = stats.collect().buildReport()
+    total_rays = sum(report['counters'].get(rays, 0) for rays, _ in RAY_COUNTERS)
+    result = dict(case)
+    result['stage_seconds'] = stage_times
+    result['total_seconds'] = sum(stage_times.values())
+    result['primary_rays'] = primary_rays
+    result['primary_rays_per_second'] = primary_rays / stage_times['render']
+    result['rays_per_second'] = total_rays / stage_times['render']
+    result['stats'] = report
+    result['peak_memory_mb'] = findPeakMemory()
+    return result
+
+
+# Base case plus one sweep per parameter, each at every resolution
+def buildCases(args):
+    sweeps = {'spheres': args.spheres, 'lights': args.lights, 'shadow_rays': args.shadow_rays,
+              'recursions': args.recursions}
+    scenes = [dict(BENCHMARK_BASE, boxes=args.boxes)]
+    for parameter, values in sweeps.items():
+        for value in values:
+            scene = dict(scenes[0], **{parameter: value})
+            if scene not in scenes:
+                scenes.append(scene)
+
+    cases = []
+    for scene in scenes:
+        for resolution in args.resolutions:
+            width, height = (int(size) for size in resolution.split('x'))
+            cases.append(dict(scene, width=width, height=height, seed=args.seed, workers=args.workers,
+                              tile_size=args.tile_size, transparency=args.t, wavefront=args.wavefront))
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ray tracer scaling benchmark')
+    parser.add_argument('report_file', type=str, help='Path of the JSON report')
+    parser.add_argument('--spheres', type=int, nargs='*', default=[10, 100, 1000], help='Sphere counts to sweep')
+    parser.add_argument('--boxes', type=int, default=BENCHMARK_BASE['boxes'], help='Number of boxes of every scene')
+    parser.add_argument('--lights', type=int, nargs='*', default=[1, 4], help='Light counts to sweep')
+    parser.add_argument('--shadow-rays', type=int, nargs='*', default=[1, 5], help='Root shadow ray counts to sweep')
+    parser.add_argument('--recursions', type=int, nargs='*', default=[1, 6], help='Recursion depths to sweep')
+    parser.add_argument('--resolutions', type=str, nargs='*', default=['50x50', '100x100'],
+                        help='Resolutions (WIDTHxHEIGHT) every scene is rendered at')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the generated scenes')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes rendering tiles in parallel')
+    parser.add_argument('--tile-size', type=int, default=64, help='Width and height of the rendered tiles')
+    parser.add_argument('-t', action='store_true', default=False, help='Consider transparency of objects in soft '
+                                                                       'shadow process')
+    parser.add_argument('--wavefront', action='store_true', default=False, help='Use the wavefront mode')
+    args = parser.parse_args()
+
+    results = []
+    cases = buildCases(args)
+    for index, case in enumerate(cases):
+        # A fresh process for every case, so each case's peak memory is its own
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(runCase, case).result()
+        results.append(result)
+        print("[{}/{}] {} spheres, {} boxes, {} lights, {} shadow rays, {} recursions at {}x{}: {:.2f} seconds"
+              .format(index + 1, len(cases), case['spheres'], case['boxes'], case['lights'], case['shadow_rays'],
+                      case['recursions'], case['width'], case['height'], result['total_seconds']))
+
+    with open(args.report_file, 'w') as f:
+        json.dump({'base': BENCHMARK_BASE, 'cases': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
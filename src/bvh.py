@@ -0,0 +1,362 @@
+import numpy as np
+from compiled_scene import mergeClosestHits, MATERIAL_TRANSPARENCY
+from surfaces.cube import intersectBoxes
+from surfaces.infinite_plane import intersectPlanes
+from surfaces.sphere import intersectSpheres
+
+# Surface area heuristic parameters
+SAH_BINS = 12
+SAH_TRAVERSAL_COST = 1.0
+SAH_INTERSECTION_COST = 1.0
+MAX_LEAF_SIZE = 4
+
+# Node bounds are padded so hits found exactly on a primitive are never culled by rounding
+BOUNDS_PADDING = 1e-7
+
+# Replaces the infinite inverse of zero direction components in the slab tests
+LARGE_INVERSE = 1e300
+
+
+# Bounding volume hierarchy over the bounded primitives (spheres and cubes) of a scene, built with the binned
+# surface area heuristic. Infinite planes have no bounds, so they are kept in a small side list that every query
+# tests linearly. The queries mirror utilities.findIntersection for a single ray (using the surface objects
+# themselves), and the batched queries of utilities for batches of rays (using the compiled scene arrays).
+class BVH:
+    def __init__(self, surfaces, compiled_scene):
+        self.surfaces = surfaces
+        self.compiled_scene = compiled_scene
+
+        # Bounded primitives, referenced by their index in the compiled sphere or box arrays
+        sphere_centers = compiled_scene.getSphereCenters()
+        sphere_radii = compiled_scene.getSphereRadii()[:, np.newaxis]
+        self.primitive_min = np.concatenate([sphere_centers - sphere_radii, compiled_scene.getBoxMin()])
+        self.primitive_max = np.concatenate([sphere_centers + sphere_radii, compiled_scene.getBoxMax()])
+        self.primitive_ids = np.concatenate([compiled_scene.getSphereIds(), compiled_scene.getBoxIds()])
+        self.number_of_spheres = len(sphere_centers)
+
+        # Flattened nodes, a leaf has count > 0 and owns order[start:start + count]
+        self.node_min = []
+        self.node_max = []
+        self.node_left = []
+        self.node_right = []
+        self.node_axis = []
+        self.node_start = []
+        self.node_count = []
+        self.order = []
+        if len(self.primitive_ids) > 0:
+            self.buildNode(np.arange(len(self.primitive_ids)))
+        self.finalizeNodes()
+
+    # Get functions
+    def getSurfaces(self):
+        return self.surfaces
+
+    def getCompiledScene(self):
+        return self.compiled_scene
+
+    # Recursively build the subtree of the given primitives and return its node index
+    def buildNode(self, primitives):
+        node = len(self.node_count)
+        bounds_min = self.primitive_min[primitives].min(axis=0)
+        bounds_max = self.primitive_max[primitives].max(axis=0)
+        self.node_min.append(bounds_min - BOUNDS_PADDING)
+        self.node_max.append(bounds_max + BOUNDS_PADDING)
+        self.node_left.append(-1)
+        self.node_right.append(-1)
+        self.node_axis.append(0)
+        self.node_start.append(len(self.order))
+        self.node_count.append(0)
+
+        # Find the best split, keep a leaf if splitting costs more than intersecting every primitive
+        count = len(primitives)
+        axis, left_mask, split_cost = self.findSplit(primitives, bounds_min, bounds_max)
+        if count <= MAX_LEAF_SIZE and split_cost >= count * SAH_INTERSECTION_COST:
+            self.makeLeaf(node, primitives)
+            return node
+
+        # No useful split found? split at the median of the widest axis
+        if left_mask is None:
+            if count <= MAX_LEAF_SIZE:
+                self.makeLeaf(node, primitives)
+                return node
+            axis = int(np.argmax(bounds_max - bounds_min))
+            centroids = (self.primitive_min[primitives, axis] + self.primitive_max[primitives, axis]) * 0.5
+            left_mask = np.zeros(count, dtype=bool)
+            left_mask[np.argsort(centroids, kind='stable')[:count // 2]] = True
+
+        self.node_axis[node] = axis
+        self.node_left[node] = self.buildNode(primitives[left_mask])
+        self.node_right[node] = self.buildNode(primitives[~left_mask])
+        return node
+
+    def makeLeaf(self, node, primitives):
+        # Keep primitives ordered by surface id so ties resolve like the linear search
+        primitives = primitives[np.argsort(self.primitive_ids[primitives], kind='stable')]
+        self.node_start[node] = len(self.order)
+        self.node_count[node] = len(primitives)
+        self.order.extend(primitives.tolist())
+
+    # Binned SAH, returns the split axis, the mask of primitives going to the left child and the split cost
+    def findSplit(self, primitives, bounds_min, bounds_max):
+        centroids = (self.primitive_min[primitives] + self.primitive_max[primitives]) * 0.5
+        centroid_min = centroids.min(axis=0)
+        centroid_max = centroids.max(axis=0)
+        node_area = surfaceArea(bounds_min, bounds_max)
+
+        best = (None, None, np.inf)
+        for axis in range(3):
+            extent = centroid_max[axis] - centroid_min[axis]
+            if extent <= 0:
+                continue
+
+            # Put the primitives in bins along the axis
+            bins = ((centroids[:, axis] - centroid_min[axis]) * (SAH_BINS / extent)).astype(int)
+            bins = np.minimum(bins, SAH_BINS - 1)
+            bin_counts = np.bincount(bins, minlength=SAH_BINS)
+            bin_min = np.full((SAH_BINS, 3), np.inf)
+            bin_max = np.full((SAH_BINS, 3), -np.inf)
+            np.minimum.at(bin_min, bins, self.primitive_min[primitives])
+            np.maximum.at(bin_max, bins, self.primitive_max[primitives])
+
+            # Bounds and counts on both sides of every split plane between bins
+            left_counts = np.cumsum(bin_counts)[:-1]
+            right_counts = np.cumsum(bin_counts[::-1])[::-1][1:]
+            left_area = surfaceArea(np.minimum.accumulate(bin_min)[:-1], np.maximum.accumulate(bin_max)[:-1])
+            right_area = surfaceArea(np.minimum.accumulate(bin_min[::-1])[::-1][1:],
+                                     np.maximum.accumulate(bin_max[::-1])[::-1][1:])
+
+            # Cost of each split, empty sides are not valid splits
+            with np.errstate(invalid='ignore'):
+                cost = SAH_TRAVERSAL_COST + SAH_INTERSECTION_COST * (
+                        left_counts * left_area + right_counts * right_area) / node_area
+            cost[(left_counts == 0) | (right_counts == 0)] = np.inf
+            split = int(np.argmin(cost))
+            if cost[split] < best[2]:
+                best = (axis, bins <= split, cost[split])
+
+        return best
+
+    def finalizeNodes(self):
+        # Arrays for the batched queries and plain lists for the fast single ray traversal
+        self.node_min = np.array(self.node_min).reshape(-1, 3)
+        self.node_max = np.array(self.node_max).reshape(-1, 3)
+        self.node_left = np.array(self.node_left, dtype=int)
+        self.node_right = np.array(self.node_right, dtype=int)
+        self.node_axis = np.array(self.node_axis, dtype=int)
+        self.node_start = np.array(self.node_start, dtype=int)
+        self.node_count = np.array(self.node_count, dtype=int)
+        self.order = np.array(self.order, dtype=int)
+        self.node_list = list(zip(self.node_min.tolist(), self.node_max.tolist(), self.node_left.tolist(),
+                                  self.node_right.tolist(), self.node_axis.tolist()))
+        self.leaf_surfaces = {}
+        self.leaf_spheres = {}
+        self.leaf_boxes = {}
+        self.leaf_columns = {}
+        for node in np.flatnonzero(self.node_count > 0).tolist():
+            primitives = self.order[self.node_start[node]:self.node_start[node] + self.node_count[node]]
+            self.leaf_surfaces[node] = [(index, self.surfaces[index]) for index in self.primitive_ids[primitives]]
+
+            # Split the leaf into compiled spheres and boxes, and find the columns order which sorts the
+            # concatenated sphere and box results back by surface id
+            spheres = primitives[primitives < self.number_of_spheres]
+            boxes = primitives[primitives >= self.number_of_spheres] - self.number_of_spheres
+            self.leaf_spheres[node] = spheres
+            self.leaf_boxes[node] = boxes
+            ids = np.concatenate([self.compiled_scene.getSphereIds()[spheres], self.compiled_scene.getBoxIds()[boxes]])
+            self.leaf_columns[node] = (np.argsort(ids, kind='stable'), np.sort(ids))
+
+        plane_ids = self.compiled_scene.getPlaneIds()
+        self.plane_surfaces = [(index, self.surfaces[index]) for index in plane_ids.tolist()]
+
+    # Single ray queries, same results as the linear functions in utilities
+
+    # Returns the entry distance of the ray into the node bounds, or None if it misses them before max_t
+    def enterNode(self, node, base_point, inverse_direction, max_t):
+        node_min, node_max = self.node_list[node][0], self.node_list[node][1]
+        t_near = 0.0
+        t_far = max_t
+        for axis in range(3):
+            t1 = (node_min[axis] - base_point[axis]) * inverse_direction[axis]
+            t2 = (node_max[axis] - base_point[axis]) * inverse_direction[axis]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            if t1 > t_near:
+                t_near = t1
+            if t2 < t_far:
+                t_far = t2
+            if t_near > t_far:
+                return None
+        return t_near
+
+    # Yields the surfaces of the leaves hit by the ray before max_t, max_t may shrink while iterating
+    def traverse(self, base_point, ray_direction, max_t_holder):
+        if len(self.node_list) == 0:
+            return
+        point = base_point.tolist()
+        direction = ray_direction.tolist()
+        inverse_direction = [1.0 / d if d != 0 else LARGE_INVERSE for d in direction]
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.enterNode(node, point, inverse_direction, max_t_holder[0]) is None:
+                continue
+            _, _, left, right, axis = self.node_list[node]
+            if left < 0:
+                yield from self.leaf_surfaces[node]
+            elif direction[axis] < 0:
+                # Visit the near child first
+                stack.append(left)
+                stack.append(right)
+            else:
+                stack.append(right)
+                stack.append(left)
+
+    # Tries to find minimum intersection point with one of the surfaces
+    def findIntersection(self, base_point, ray_direction):
+        intersect_t = np.inf
+        intersect_index = -1
+        for index, surface in self.plane_surfaces:
+            t = surface.findIntersection(base_point, ray_direction)
+            if 0 < t < intersect_t:
+                intersect_t = t
+                intersect_index = index
+
+        max_t_holder = [intersect_t]
+        for index, surface in self.traverse(base_point, ray_direction, max_t_holder):
+            t = surface.findIntersection(base_point, ray_direction)
+            # Found closer intersection point? (equal ties go to the surface that comes first in the scene)
+            if 0 < t and (t < intersect_t or (t == intersect_t and index < intersect_index)):
+                intersect_t = t
+                intersect_index = index
+                max_t_holder[0] = t
+
+        # Intersection not found?
+        if intersect_t == np.inf:
+            return np.inf, None
+
+        return intersect_t, self.surfaces[intersect_index]
+
+    # Batched queries, base_points and ray_directions are (N, 3) arrays
+
+    # Yields (leaf node, indices of the rays entering it) for the rays of the batch, max_t is per ray and may
+    # shrink while iterating. Ordered traversal visits the near child of most rays first, otherwise the leaves come
+    # in a fixed order which does not depend on the other rays of the batch
+    def traverseBatch(self, base_points, ray_directions, max_t, ordered=True):
+        if len(self.node_count) == 0:
+            return
+        with np.errstate(divide='ignore'):
+            inverse_directions = np.where(ray_directions != 0, 1 / ray_directions, LARGE_INVERSE)
+        stack = [(0, np.arange(len(ray_directions)))]
+        while stack:
+            node, rays = stack.pop()
+
+            # Slab test of the node bounds for the active rays
+            with np.errstate(over='ignore', invalid='ignore'):
+                t1 = (self.node_min[node] - base_points[rays]) * inverse_directions[rays]
+                t2 = (self.node_max[node] - base_points[rays]) * inverse_directions[rays]
+            t_near = np.maximum(np.minimum(t1, t2).max(axis=1), 0)
+            t_far = np.minimum(np.maximum(t1, t2).min(axis=1), max_t[rays])
+            rays = rays[t_near <= t_far]
+            if len(rays) == 0:
+                continue
+
+            if self.node_count[node] > 0:
+                yield node, rays
+            elif ordered and np.sum(ray_directions[rays, self.node_axis[node]] < 0) * 2 > len(rays):
+                # Visit the near child of most rays first
+                stack.append((self.node_left[node], rays))
+                stack.append((self.node_right[node], rays))
+            else:
+                stack.append((self.node_right[node], rays))
+                stack.append((self.node_left[node], rays))
+
+    # Intersection t values of the rays with the primitives of a leaf, columns are sorted by surface id
+    def intersectLeaf(self, node, base_points, ray_directions):
+        spheres = self.leaf_spheres[node]
+        boxes = self.leaf_boxes[node]
+        t = np.concatenate([
+            intersectSpheres(self.compiled_scene.getSphereCenters()[spheres],
+                             self.compiled_scene.getSphereRadii()[spheres], base_points, ray_directions),
+            intersectBoxes(self.compiled_scene.getBoxMin()[boxes], self.compiled_scene.getBoxMax()[boxes],
+                           base_points, ray_directions)], axis=1)
+        columns, ids = self.leaf_columns[node]
+        return t[:, columns], ids
+
+    def intersectPlanes(self, base_points, ray_directions):
+        return intersectPlanes(self.compiled_scene.getPlaneNormals(), self.compiled_scene.getPlaneOffsets(),
+                               base_points, ray_directions)
+
+    # Batched findIntersection, returns the minimum t of every ray (np.inf if not found) and the surface id of the
+    # intersected surface (-1 if not found)
+    def findIntersections(self, base_points, ray_directions):
+        intersect_t = np.full(len(ray_directions), np.inf)
+        intersect_id = np.full(len(ray_directions), -1)
+        if len(self.plane_surfaces) > 0:
+            intersect_t, intersect_id = mergeClosestHits(intersect_t, intersect_id,
+                                                         self.intersectPlanes(base_points, ray_directions),
+                                                         self.compiled_scene.getPlaneIds())
+
+        for node, rays in self.traverseBatch(base_points, ray_directions, intersect_t):
+            t, ids = self.intersectLeaf(node, base_points[rays], ray_directions[rays])
+            intersect_t[rays], intersect_id[rays] = mergeClosestHits(intersect_t[rays], intersect_id[rays], t, ids)
+
+        return intersect_t, intersect_id
+
+    # Batched shadow query, returns how much light each ray transmits to its distance, the product of the
+    # transparency of every surface it passes (surface_transparency is per surface id). A ray stops as soon as its
+    # transmission drops to the epsilon of the shadow cache, and the cached occluder of the light is tested first
+    def findTransmission(self, base_points, ray_directions, distances, surface_transparency, shadow_cache=None):
+        transmission = np.ones(len(ray_directions))
+        epsilon = shadow_cache.getEpsilon() if shadow_cache is not None else 0.0
+
+        # Rays done with get a negative max distance so the traversal drops them
+        max_t = distances.copy()
+
+        # Mul with the transparency of the surfaces found between the points and the light
+        def occlude(rays, t, ids):
+            blocked = (t > 0) & (t < distances[rays, np.newaxis])
+            transparency = np.where(blocked, surface_transparency[ids], 1.0)
+            transmission[rays] *= np.prod(transparency, axis=1)
+
+            # Stop rays which transmit (almost) nothing, remember an opaque surface which blocked them
+            done = transmission[rays] <= epsilon
+            if np.any(done):
+                transmission[rays[done]] = 0.0
+                max_t[rays[done]] = -1.0
+                occluder = ids[np.argmin(transparency[np.argmax(done)])]
+                if shadow_cache is not None and surface_transparency[occluder] <= epsilon:
+                    shadow_cache.setLastOccluder(occluder)
+
+        # Rays blocked by the last occluder of the light (opaque) are done, no need to look further
+        if shadow_cache is not None and shadow_cache.getLastOccluder() >= 0:
+            occluder = shadow_cache.getLastOccluder()
+            t = self.compiled_scene.intersectSurface(occluder, base_points, ray_directions)
+            occlude(np.arange(len(ray_directions)), t[:, np.newaxis], np.array([occluder]))
+
+        if len(self.plane_surfaces) > 0:
+            rays = np.flatnonzero(max_t >= 0)
+            occlude(rays, self.intersectPlanes(base_points[rays], ray_directions[rays]),
+                    self.compiled_scene.getPlaneIds())
+
+        for node, rays in self.traverseBatch(base_points, ray_directions, max_t, ordered=False):
+            t, ids = self.intersectLeaf(node, base_points[rays], ray_directions[rays])
+            occlude(rays, t, ids)
+
+        return transmission
+
+    # Product of the transparencies of the surfaces blocking every ray before its distance, distances is (N,)
+    def findTransparencyFactors(self, base_points, ray_directions, distances, shadow_cache=None):
+        transparency = self.compiled_scene.getMaterialTable()[:, MATERIAL_TRANSPARENCY]
+        surface_transparency = transparency[self.compiled_scene.getSurfaceMaterials()]
+        return self.findTransmission(base_points, ray_directions, distances, surface_transparency, shadow_cache)
+
+    # Returns 1.0 for rays which reach their distance and 0.0 for blocked rays
+    def hasIntersections(self, base_points, ray_directions, distances, shadow_cache=None):
+        surface_transparency = np.zeros(self.compiled_scene.getNumberOfSurfaces())
+        return self.findTransmission(base_points, ray_directions, distances, surface_transparency, shadow_cache)
+
+
+# Surface area of axis aligned boxes given by their min and max points
+def surfaceArea(bounds_min, bounds_max):
+    extent = np.maximum(bounds_max - bounds_min, 0)
+    return 2 * (extent[..., 0] * extent[..., 1] + extent[..., 1] * extent[..., 2] + extent[..., 2] * extent[..., 0])
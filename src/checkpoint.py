@@ -0,0 +1,77 @@
+import json
+import os
+import time
+import numpy as np
+
+# Suffixes of the sidecar files of a checkpoint: settings it was made with, image, and finished tiles bitmap
+SETTINGS_SUFFIX = '.json'
+IMAGE_SUFFIX = '.image'
+TILES_SUFFIX = '.tiles'
+
+# Seconds between flushes of the finished tiles to disk
+CHECKPOINT_INTERVAL = 10.0
+
+
+# Sidecar files of a render in progress: the image as a memory mapped uint8 framebuffer and a bitmap of the finished
+# tiles. A tile is marked finished on disk only after its pixels were flushed, so a render that dies at any point
+# can resume from the tiles marked finished. Since every pixel seeds its own randomness, the resumed image is the
+# same as an uninterrupted one
+class RenderCheckpoint:
+    def __init__(self, file_path, settings, tiles, resume=False):
+        self.file_path = file_path
+        self.settings = settings
+        self.tiles = tiles
+        self.tile_indices = {tile: i for i, tile in enumerate(tiles)}
+        self.last_flush = time.perf_counter()
+        shape = (max(tile[3] for tile in tiles), max(tile[2] for tile in tiles), 3)
+
+        if resume and os.path.exists(file_path + SETTINGS_SUFFIX):
+            with open(file_path + SETTINGS_SUFFIX, 'r') as f:
+                saved_settings = json.load(f)
+            if saved_settings != settings:
+                raise ValueError("Checkpoint {} was made with different settings, can not resume".format(file_path))
+            self.image = np.memmap(file_path + IMAGE_SUFFIX, dtype=np.uint8, mode='r+', shape=shape)
+            self.finished_on_disk = np.memmap(file_path + TILES_SUFFIX, dtype=np.uint8, mode='r+',
+                                              shape=(len(tiles),))
+        else:
+            self.image = np.memmap(file_path + IMAGE_SUFFIX, dtype=np.uint8, mode='w+', shape=shape)
+            self.finished_on_disk = np.memmap(file_path + TILES_SUFFIX, dtype=np.uint8, mode='w+',
+                                              shape=(len(tiles),))
+            self.finished_on_disk.flush()
+            with open(file_path + SETTINGS_SUFFIX, 'w') as f:
+                json.dump(settings, f)
+
+        # Tiles finished since the last flush are only marked in memory
+        self.finished = np.array(self.finished_on_disk)
+
+    # Get functions
+    def getFinishedTiles(self):
+        return [tile for tile, finished in zip(self.tiles, self.finished) if finished]
+
+    def getUnfinishedTiles(self):
+        return [tile for tile, finished in zip(self.tiles, self.finished) if not finished]
+
+    def getTile(self, tile):
+        x0, y0, x1, y1 = tile
+        return self.image[y0:y1, x0:x1]
+
+    # Store a rendered tile of colors in [0, 255], flushing the finished tiles every CHECKPOINT_INTERVAL seconds
+    def addTile(self, tile, tile_array):
+        x0, y0, x1, y1 = tile
+        self.image[y0:y1, x0:x1] = np.uint8(tile_array)
+        self.finished[self.tile_indices[tile]] = 1
+        if time.perf_counter() - self.last_flush >= CHECKPOINT_INTERVAL:
+            self.flush()
+
+    # Write the pixels first, then mark their tiles finished
+    def flush(self):
+        self.image.flush()
+        self.finished_on_disk[:] = self.finished
+        self.finished_on_disk.flush()
+        self.last_flush = time.perf_counter()
+
+    # Delete the sidecar files once the image is saved
+    def remove(self):
+        del self.image, self.finished_on_disk
+        for suffix in (SETTINGS_SUFFIX, IMAGE_SUFFIX, TILES_SUFFIX):
+            os.remove(self.file_path + suffix)
@@ -1,17 +1,27 @@
 import numpy as np
-import random
+from counter_random import TRANSPARENCY_PATH, REFLECTION_PATH, SHADOW_STREAM, SELECTION_STREAM, ROULETTE_STREAM, \
+    hashKeys, counterRandom
+from compiled_scene import LIGHT_SHADOW_INTENSITY, compileMaterials, compileLights
 from light import Light
 from material import Material
 from scene_settings import SceneSettings
+from shadow_cache import ShadowCache
+from render_stats import stats, timed
 from ray import Ray
+from shading import findPhongColors
+from shadow_samples import SHADOW_SAMPLE_SETS, createShadowSamples, findPerpendicularBasis, findPointsOnRectangles
 from surfaces.cube import Cube
 from surfaces.infinite_plane import InfinitePlane
 from surfaces.sphere import Sphere
 from utilities import *
 
+# Probe points of the adaptive soft shadows as (row, col) fractions of the light rectangle:
+# the center, the four corners and then the four edge midpoints
+SHADOW_PROBE_POSITIONS = np.array([[0.5, 0.5], [0, 0], [0, 1], [1, 0], [1, 1], [0, 0.5], [0.5, 0], [0.5, 1], [1, 0.5]])
+
 
 class ColorFinder:
-    def __init__(self, scene_settings, lights, surfaces, materials, background_color, softshadow_func):
+    def __init__(self, scene_settings, lights, surfaces, materials, background_color, softshadow_func, seed=42):
         self.scene_settings = scene_settings
         self.lights = lights
         self.surfaces = surfaces
@@ -19,12 +29,29 @@ class ColorFinder:
         self.background_color = background_color
         self.softshadow_func = softshadow_func
 
+        # Material and light tables of the vectorized phong kernel
+        self.material_table = compileMaterials(materials)
+        self.light_table = compileLights(lights)
+
         # Prevents black spots
         self.black_spots_factor = 0.0008
 
-        # Seed for random (used sha256 for creating seed like in random default)
-        seed = 42
-        random.seed(seed)
+        # Shadow query state of every light
+        self.shadow_caches = {}
+
+        # Soft shadow samples of every light, created on first use
+        self.shadow_samples = None
+
+        # Materials hit by the secondary rays of the current pixel
+        self.path_materials = set()
+
+        # Counter based random numbers keyed by the pixel, bounce depth and path of the hit being shaded, so the image
+        # does not depend on the order (or the process) in which pixels are rendered
+        self.seed = seed
+        self.pixel = (0, 0)
+        self.depth = 0
+        self.path = 0
+        self.path_key = hashKeys(seed, 0, 0, 0, 0)
 
     # Get and set functions
     def getSceneSettings(self):
@@ -42,90 +69,172 @@ class ColorFinder:
     def getBackgroundColor(self):
         return self.background_color
 
+    def getPathMaterials(self):
+        return self.path_materials
+
+    def resetPathMaterials(self):
+        self.path_materials = set()
+
     def setSceneSettings(self, scene_settings):
         self.scene_settings = scene_settings
 
     def setLights(self, lights):
         self.lights = lights
+        self.light_table = compileLights(lights)
+        self.shadow_samples = None
 
     def setSurfaces(self, surfaces):
         self.surfaces = surfaces
 
     def setMaterials(self, materials):
         self.materials = materials
+        self.material_table = compileMaterials(materials)
 
     def setBackgroundColor(self, background_color):
         self.background_color = background_color
 
-    def calculateRaysPrecentage(self, ray, light, N):
-        # Find plane
-        # N · P + d = 0 => d = - N · P
-        N = normalize(N)
-        light_position = light.getPosition()
-        distance = -light_position.dot(N)
-
-        # Find where point with coordinates x = 1, y = 1 on plane using z =  - (Ax + By + D) / C
-        z = -(N[0] + N[1] + distance) / N[2]
-        diagonal_vector = np.array([1, 1, z])
-        diagonal_vector = diagonal_vector - light_position
+    # Key the random numbers of the hit of a pixel at the given bounce depth and path
+    def seedPixel(self, row, col, depth=0, path=0, path_key=None):
+        self.pixel = (row, col)
+        self.setPath(depth, path, path_key)
 
-        # Normalize diagonal vector
-        diagonal_vector = normalize(diagonal_vector)
+    def setPath(self, depth, path, path_key=None):
+        self.depth = depth
+        self.path = path
+        self.path_key = self.findPathKeys(*self.pixel, depth, path) if path_key is None else path_key
 
-        # Finds perpendicular vector to diagonal vector
-        up_vector = np.cross(diagonal_vector, N)
+    # Random keys of hits, arrays of pixels, depths and paths give an array of keys
+    def findPathKeys(self, rows, cols, depths, paths):
+        return hashKeys(self.seed, rows, cols, depths, paths)
 
-        # Normalize up_vector
-        up_vector = normalize(up_vector)
+    # Random numbers of a stream of the current hit, arrays of counters give arrays of numbers
+    def drawRandom(self, stream, *counters):
+        return counterRandom(self.path_key, stream, *counters)
 
-        # Finds the left up point of the rectangle
-        light_radius = light.getRadius()
+    # Precomputed soft shadow samples of every light for the current number of shadow rays
+    def getShadowSamples(self):
+        shadow_rays = self.scene_settings.getShadowRays()
+        if self.shadow_samples is None or self.shadow_samples.shape[2] != shadow_rays * shadow_rays:
+            self.shadow_samples = createShadowSamples(len(self.lights), shadow_rays, self.seed)
+        return self.shadow_samples
+
+    # Fraction of the light of the given lights that reaches P hit points: lights is (P,) light indices,
+    # points_on_surface (P, 3), L the (P, 3) directions from the points to the lights and path_keys the (P,) random
+    # keys of the hits. The shadow rays of all the points are cast together, one batch per light. Returns the (P,)
+    # fractions and the (P,) numbers of shadow rays cast
+    @timed('findRaysPercentages')
+    def findRaysPercentages(self, lights, points_on_surface, L, path_keys):
+        percentages = np.zeros(len(lights))
+        rays = np.zeros(len(lights), dtype=int)
+        shadow_probes = self.scene_settings.getShadowProbes()
+        for light_index in np.unique(lights):
+            light = self.lights[light_index]
+            light_position = light.getPosition()
+            pairs = np.flatnonzero(lights == light_index)
+            points = points_on_surface[pairs]
+
+            # Define rectangles centered at the light source, perpendicular to the directions from the light to the
+            # points and as wide as the defined light radius, their sides are the rows of the bases
+            rectangles = findPerpendicularBasis(normalizeRows(-L[pairs])) * light.getRadius()
+
+            # Adaptive mode? Cast a few probe rays first, and trust them if they agree (fully lit or fully occluded)
+            if shadow_probes > 0:
+                transparency_factors = self.castShadowRays(
+                    findPointsOnRectangles(light_position, SHADOW_PROBE_POSITIONS[:shadow_probes] - 0.5, rectangles),
+                    points, light)
+                rays[pairs] += shadow_probes
+                agree = (np.max(transparency_factors, axis=1) - np.min(transparency_factors, axis=1) <=
+                         self.scene_settings.getShadowTolerance())
+                percentages[pairs[agree]] = np.mean(transparency_factors[agree], axis=1)
+                pairs, points, rectangles = pairs[~agree], points[~agree], rectangles[~agree]
+                if len(pairs) == 0:
+                    continue
+
+            # One random point in every cell of an N*N grid on the rectangle, N being the number of shadow rays: one
+            # of the precomputed sample sets of the light, picked at random for every hit to avoid banding
+            sample_sets = (counterRandom(path_keys[pairs], SHADOW_STREAM, light_index) * SHADOW_SAMPLE_SETS).astype(int)
+            samples = self.getShadowSamples()[light_index, sample_sets]
+
+            # Aggregate the values of all rays that were cast
+            transparency_factors = self.castShadowRays(findPointsOnRectangles(light_position, samples, rectangles),
+                                                       points, light)
+            rays[pairs] += samples.shape[1]
+            percentages[pairs] = np.sum(transparency_factors, axis=1) / samples.shape[1]
+        return percentages, rays
+
+    # Shadow query state of the light
+    def getShadowCache(self, light):
+        if light not in self.shadow_caches:
+            self.shadow_caches[light] = ShadowCache(self.scene_settings.getShadowEpsilon())
+        return self.shadow_caches[light]
+
+    # Cast shadow rays from P points on surfaces to the points on the light of each of them, points_on_light is
+    # (P, S, 3) and points_on_surface (P, 3). Returns how much light arrives through each ray, a (P, S) array
+    def castShadowRays(self, points_on_light, points_on_surface, light):
+        # Calculate distance between points
+        p = points_on_light - points_on_surface[:, np.newaxis]
+        distances = np.linalg.norm(p, axis=-1)
+
+        # Rays directions
+        rays_directions = p / distances[..., np.newaxis]
+
+        # Calculate rays bases (0.0002 prevents black spots)
+        base_points = points_on_surface[:, np.newaxis] + self.black_spots_factor * rays_directions
+
+        # Cast all the shadow rays together to know how much light arrives
+        transparency_factors = self.softshadow_func(base_points.reshape(-1, 3), rays_directions.reshape(-1, 3),
+                                                    distances.reshape(-1), self.surfaces, self.materials,
+                                                    self.getShadowCache(light))
+        stats.count('shadow_rays', len(transparency_factors))
+        stats.count('shadow_rays_blocked', int(np.count_nonzero(transparency_factors == 0)))
+        return transparency_factors.reshape(distances.shape)
+
+    # Contribution based termination of reflection or transparency paths with the given accumulated weights, draws are
+    # their russian roulette random numbers. Returns the factors the colors of the paths are scaled by, or 0 where a
+    # path is terminated. With russian roulette a path below the minimum weight survives with probability
+    # weight / min_weight and is scaled up to stay unbiased
+    def findPathSurvivals(self, weights, draws):
+        min_weight = self.scene_settings.getMinWeight()
+        survivals = np.ones(len(weights))
+        below = weights < min_weight
+        if not self.scene_settings.getRussianRoulette():
+            survivals[below] = 0.0
+            return survivals
+
+        probabilities = weights[below] / min_weight
+        survive = draws[below] < probabilities
+        survivals[below] = np.divide(1.0, probabilities, out=np.zeros(len(probabilities)), where=survive)
+        return survivals
+
+    # Path survival of the current hit (the child path), see findPathSurvivals
+    def findPathSurvival(self, weight):
+        if weight >= self.scene_settings.getMinWeight():
+            return 1.0
+        return self.findPathSurvivals(np.array([weight]), np.array([self.drawRandom(ROULETTE_STREAM)]))[0]
+
+    # Color of a terminated path, the background like a path which reached the recursion limit, or black with
+    # russian roulette so the survivors' scaling keeps the average
+    def getTerminatedColor(self):
+        if self.scene_settings.getRussianRoulette():
+            return np.zeros(3)
+        return self.background_color
 
-        # Move up
-        left_up_point = light_position + (up_vector * (-0.5 * light_radius))
+    def calculateTransparencyColor(self, ray, max_recursion, weight=1.0):
+        # The transparency ray is a child path
+        depth, path, path_key = self.depth, self.path, self.path_key
+        self.setPath(depth + 1, path * 3 + TRANSPARENCY_PATH)
+        color = self.traceTransparencyColor(ray, max_recursion, weight)
+        self.setPath(depth, path, path_key)
+        return color
 
-        # Move left
-        left_up_point += (diagonal_vector * (-0.5 * light_radius))
+    # Returns the clipped color of the transparency ray, its unclipped russian roulette excess (see combineColors) and
+    # the factor its color is scaled by
+    def traceTransparencyColor(self, ray, max_recursion, weight):
+        # Path contributes too little? terminate it (the last level returns the background color anyway)
+        survival = self.findPathSurvival(weight) if max_recursion > 1 else 1.0
+        if survival == 0:
+            return np.clip(self.getTerminatedColor(), 0, 1), np.zeros(3), 1.0
 
-        # Define a rectangle on that plane, centered at the light source and as wide as the
-        # defined light radius. Divide the rectangle into a grid of N*N cells, where N is the number of shadow rays
-        shadow_rays = self.scene_settings.getShadowRays()
-        cell_proportion = 1.0 / shadow_rays
-        rectangle_height = diagonal_vector * light_radius
-        rectangle_width = up_vector * light_radius
-        cell_height = cell_proportion * rectangle_height
-        cell_width = cell_proportion * rectangle_width
-
-        # Aggregate the values of all rays that were cast and count how many of them hit
-        # the required point on the surface.
-        num_of_rays = 0
-        for i in range(shadow_rays):
-            for j in range(shadow_rays):
-                # Random points selection to avoid banding
-                x = random.random()
-                y = random.random()
-
-                # Calculate distance between points
-                point_on_cell = left_up_point + (cell_height * (i + x)) + (cell_width * (j + y))
-                point_on_surface = ray.getIntersectionPoint()
-                p = point_on_cell - point_on_surface
-                distance = np.linalg.norm(p)
-
-                # Ray direction
-                ray_direction = p / distance
-
-                # Calculate ray base (0.0002 prevents black spots)
-                p = point_on_surface + self.black_spots_factor * ray_direction
-
-                # Create ray if intersect with surface to know if no light arrives
-                transparency_factor = self.softshadow_func(p, ray_direction, distance, self.surfaces, self.materials)
-
-                num_of_rays += (1.0 * transparency_factor)
-
-        percentage = num_of_rays / np.power(shadow_rays, 2)
-        return percentage
-
-    def calculateTransparencyColor(self, ray, max_recursion):
         # Direction of ray
         ray_direction = ray.getDirection()
 
@@ -134,19 +243,39 @@ class ColorFinder:
 
         # Find intersection with each surfaces
         color = self.background_color
+        excess = np.zeros(3)
         t, surface = findIntersection(p, ray_direction, self.surfaces)
+        stats.count('transparency_rays')
 
-        # Have intersection with surface? continue recursively
+        # Have intersection with surface? continue recursively, survivors carry their scaled weight
         if t != np.inf:
+            stats.count('transparency_hits')
             material_index = surface.getMaterial() - 1
+            self.path_materials.add(material_index)
             transparency_ray = Ray(p, ray_direction, p + t * ray_direction)
-            color = self.calculateColor(transparency_ray, self.materials[material_index], surface, max_recursion - 1)
+            color, excess = self.traceColor(transparency_ray, self.materials[material_index], surface,
+                                            max_recursion - 1, weight * survival)
 
         # Prevent overflow which can happen because of the recursion
         color = np.clip(color, 0, 1)
+        return color, excess, survival
+
+    def calculateReflectanceColor(self, ray, N, max_recursion, material, weight=1.0):
+        # The reflection ray is a child path
+        depth, path, path_key = self.depth, self.path, self.path_key
+        self.setPath(depth + 1, path * 3 + REFLECTION_PATH)
+        color = self.traceReflectanceColor(ray, N, max_recursion, material, weight)
+        self.setPath(depth, path, path_key)
         return color
 
-    def calculateReflectanceColor(self, ray, N, max_recursion, material):
+    # Returns the clipped reflectance color, its unclipped russian roulette excess (see combineColors) and the factor
+    # it is scaled by
+    def traceReflectanceColor(self, ray, N, max_recursion, material, weight):
+        # Path contributes too little? terminate it (the last level returns the background color anyway)
+        survival = self.findPathSurvival(weight) if max_recursion > 1 else 1.0
+        if survival == 0:
+            return np.clip(self.getTerminatedColor() * material.getReflectionColor(), 0, 1), np.zeros(3), 1.0
+
         # Direction of reflected ray
         R = calculateReflectionDirection(ray.getDirection(), N)
 
@@ -155,61 +284,129 @@ class ColorFinder:
 
         # Find intersection with each surfaces
         color = self.background_color
+        excess = np.zeros(3)
         t, surface = findIntersection(p, R, self.surfaces)
+        stats.count('reflection_rays')
 
-        # Have intersection with surface? continue recursively
+        # Have intersection with surface? continue recursively, survivors carry their scaled weight
         if t != np.inf:
+            stats.count('reflection_hits')
             material_index = surface.getMaterial() - 1
+            self.path_materials.add(material_index)
             reflectance_ray = Ray(p, R, p + t * R)
-            color = self.calculateColor(reflectance_ray, self.materials[material_index], surface, max_recursion - 1)
+            color, excess = self.traceColor(reflectance_ray, self.materials[material_index], surface,
+                                            max_recursion - 1, weight * survival)
 
         color = color * material.getReflectionColor()
 
         # Prevent overflow which can happen because of the recursion
         color = np.clip(color, 0, 1)
-        return color
-
-    # Calculate specular color
-    def calculateSpecularColor(self, light, material, N, L, ray_direction):
-        # Calculate reflected ray
-        R = (N * (2 * N.dot(L))) - L
+        return color, excess * material.getReflectionColor(), survival
 
-        # Calculate specular part
-        specular = R.dot(-ray_direction)
-        specular = np.power(specular, material.getShininess())
-        specular = specular * material.getSpecularColor() * light.getSpecularIntensity() * light.getColor()
-        return specular
+    # Phong colors of all the lights at N hits on surfaces of the given material ids, before shadows (see
+    # findPhongColors). Returns the (N, L, 3) colors, the (N, L) lit mask and the (N, L, 3) directions to the lights
+    def findPhongColors(self, material_ids, hit_points, normals, ray_directions):
+        return findPhongColors(self.material_table[material_ids], self.light_table, hit_points, normals,
+                               ray_directions)
 
     # Calculate color as using phong method
     def calculateSpecularAndDiffuseColor(self, ray, N, material, surface):
-        color = np.zeros(3)
-        intersection = ray.getIntersectionPoint()
-        ray_direction = ray.getDirection()
-        for light in self.lights:
-            L = light.getPosition() - intersection
-            L = normalize(L)
-
-            # Calculate diffuse color part
-            dot = L.dot(N)
-            if dot < 0:
-                continue
-            diffuse_and_specular_color = light.getColor() * dot * material.getDiffuseColor()
-
-            # Calculate specular part
-            diffuse_and_specular_color += self.calculateSpecularColor(light, material, N, L, ray_direction)
-
-            # Calculate diffuse and specular color
-            percentage_of_rays = self.calculateRaysPrecentage(ray, light, -L)
-            color += diffuse_and_specular_color * (
-                    (1 - light.getShadowIntensity()) + (percentage_of_rays * light.getShadowIntensity()))
-
-        return color
-
-    # Calculate pixel color as instructed in project document
-    def calculateColor(self, ray, material, surface, max_recursion):
+        hit_points = ray.getIntersectionPoint()[np.newaxis]
+        phong = self.findPhongColors([surface.getMaterial() - 1], hit_points, N[np.newaxis],
+                                     ray.getDirection()[np.newaxis])
+        colors, _ = self.findSpecularAndDiffuseColors(phong, hit_points, np.array([self.path_key], dtype=np.uint64))
+        return colors[0]
+
+    # Calculate color as using phong method at N hits together. phong holds the (N, L, 3) colors, (N, L) lit mask and
+    # (N, L, 3) light directions of the hits from findPhongColors, hit_points is (N, 3) and path_keys are the (N,)
+    # random keys of the hits. Only the lights in front of the surfaces cast shadow rays, and the shadow rays of all
+    # the hits are cast together. Returns the (N, 3) colors and the (N,) numbers of shadow rays cast
+    @timed('findSpecularAndDiffuseColors')
+    def findSpecularAndDiffuseColors(self, phong, hit_points, path_keys):
+        phong_colors, lit, light_directions = phong
+        stats.count('lit_lights', int(np.count_nonzero(lit)))
+
+        # Shadows only lower the phong color, lights which can not reach the threshold are skipped
+        light_threshold = self.scene_settings.getLightThreshold()
+        contributions = np.max(phong_colors, axis=2)
+        if light_threshold > 0:
+            culled = lit & (contributions < light_threshold)
+            stats.count('culled_lights', int(np.count_nonzero(culled)))
+            lit = lit & ~culled
+
+        # Lights without shadows need no shadow rays, the others may be sampled
+        shadow_intensities = self.light_table[:, LIGHT_SHADOW_INTENSITY]
+        shadowed = lit & (shadow_intensities != 0)
+        light_weights = self.selectLights(shadowed, contributions, path_keys)
+
+        # Calculate the fraction of the light of every sampled light which reaches its hit
+        hits, lights = np.nonzero(light_weights)
+        percentages = np.zeros(lit.shape)
+        percentages[hits, lights], rays = self.findRaysPercentages(lights, hit_points[hits],
+                                                                   light_directions[hits, lights], path_keys[hits])
+
+        # Calculate diffuse and specular color, light by light
+        colors = np.zeros((len(lit), 3))
+        for light_index in np.flatnonzero(np.any(lit, axis=0)):
+            # Light without shadows? no need to cast shadow rays
+            unshadowed = lit[:, light_index] & ~shadowed[:, light_index]
+            colors[unshadowed] += phong_colors[unshadowed, light_index]
+
+            sampled = light_weights[:, light_index] != 0
+            shadow_intensity = shadow_intensities[light_index]
+            colors[sampled] += light_weights[sampled, light_index, np.newaxis] * phong_colors[sampled, light_index] * (
+                    (1 - shadow_intensity) + (percentages[sampled, light_index, np.newaxis] * shadow_intensity))
+
+        return colors, np.bincount(hits, weights=rays, minlength=len(lit)).astype(int)
+
+    # Light sampling: at every hit with more than light_samples lights to cast shadow rays to (the (N, L) lights mask),
+    # pick light_samples of them at random, with probabilities proportional to their (N, L) contributions, and weight
+    # each picked light by how many times it was picked / (light_samples * probability) so the expected color is
+    # unchanged. Returns the (N, L) weights of the lights, 0 for the ones not picked
+    def selectLights(self, lights, contributions, path_keys):
+        light_samples = self.scene_settings.getLightSamples()
+        weights = lights.astype(float)
+        hits = np.flatnonzero(np.count_nonzero(lights, axis=1) > light_samples) if light_samples > 0 else []
+        if len(hits) == 0:
+            return weights
+
+        pool = lights[hits]
+        contributions = np.where(pool, np.maximum(contributions[hits], 0), 0)
+        cumulative = np.cumsum(contributions, axis=1)
+        totals = cumulative[:, -1]
+
+        # Every draw picks the first light whose cumulative contribution is above it, the last light of the pool if
+        # rounding puts it at the total
+        draws = counterRandom(path_keys[hits, np.newaxis], SELECTION_STREAM, np.arange(light_samples)) * \
+            totals[:, np.newaxis]
+        above = cumulative[:, np.newaxis, :] > draws[:, :, np.newaxis]
+        last = pool.shape[1] - 1 - np.argmax(pool[:, ::-1], axis=1)
+        picked_lights = np.where(np.any(above, axis=2), np.argmax(above, axis=2), last[:, np.newaxis])
+        picks = np.zeros(pool.shape)
+        np.add.at(picks, (np.arange(len(hits))[:, np.newaxis], picked_lights), 1)
+
+        # Hits whose lights contribute nothing pick none
+        picks[~(totals > 0)] = 0
+        picked = picks > 0
+        stats.count('unsampled_lights', int(np.count_nonzero(pool) - np.count_nonzero(picked)))
+        probabilities = np.divide(contributions, totals[:, np.newaxis], out=np.zeros(pool.shape),
+                                  where=totals[:, np.newaxis] > 0)
+        sampled_weights = np.zeros(pool.shape)
+        sampled_weights[picked] = picks[picked] / (light_samples * probabilities[picked])
+        weights[hits] = sampled_weights
+        return weights
+
+    # Calculate pixel color as instructed in project document, weight is the accumulated weight of the path
+    # (how much the color of the ray contributes to the pixel)
+    def calculateColor(self, ray, material, surface, max_recursion, weight=1.0):
+        color, excess = self.traceColor(ray, material, surface, max_recursion, weight)
+        return np.clip(color + excess, 0, 1)
+
+    # The color of a hit split into the clipped color and the unclipped russian roulette excess (see combineColors)
+    def traceColor(self, ray, material, surface, max_recursion, weight):
         # Passed the limit of recursion?
         if max_recursion == 0:
-            return self.background_color
+            return self.background_color, np.zeros(3)
 
         # Init color
         color = np.zeros(3)
@@ -227,19 +424,35 @@ class ColorFinder:
         color += self.calculateSpecularAndDiffuseColor(ray, N, material, surface)
 
         # Calculate color caused by transparency
-        transparency_color = np.zeros(3)
+        transparency_color, transparency_excess, transparency_scale = np.zeros(3), np.zeros(3), 1.0
         if material.getTransparency() > 0:
-            transparency_color = self.calculateTransparencyColor(ray, max_recursion)
+            transparency_color, transparency_excess, transparency_scale = self.calculateTransparencyColor(
+                ray, max_recursion, weight * material.getTransparency())
 
         # Calculate color caused by reflectance
-        reflectance_color = np.zeros(3)
+        reflectance_color, reflectance_excess, reflectance_scale = np.zeros(3), np.zeros(3), 1.0
         if np.any(material.getReflectionColor() != 0):
-            reflectance_color = self.calculateReflectanceColor(ray, N, max_recursion, material)
+            reflectance_color, reflectance_excess, reflectance_scale = self.calculateReflectanceColor(
+                ray, N, max_recursion, material, weight * np.max(material.getReflectionColor()))
 
         # Calculate color of surface
-        color = (
-                        1 - material.getTransparency()) * color + material.getTransparency() * transparency_color + reflectance_color
-
-        # Prevent overflow which can happen because of the recursion
-        color = np.clip(color, 0, 1)
-        return color
+        return combineColors(color, material.getTransparency(), transparency_color, transparency_excess,
+                             transparency_scale, reflectance_color, reflectance_excess, reflectance_scale)
+
+
+# Calculate the color of surfaces from their local (specular and diffuse) colors and the colors of their transparency
+# and reflection rays, and prevent overflow which can happen because of the recursion. Russian roulette survivors
+# are scaled by 1 / p after the clip, so it does not cut the scaling: the clipped color is the one of the unscaled
+# children, and the unclipped excess adds (scale - 1) times the difference every survivor makes to it, and the
+# excess of the children. The pixel color is the clipped color of its primary hit plus its excess, clipped. Works on
+# single colors or on (N, 3) arrays, with (N, 1) transparencies and scales. Returns the color and the excess
+def combineColors(local_colors, transparency, transparency_colors, transparency_excess, transparency_scales,
+                  reflectance_colors, reflectance_excess, reflectance_scales):
+    local_colors = (1 - transparency) * local_colors
+    colors = np.clip(local_colors + transparency * transparency_colors + reflectance_colors, 0, 1)
+    without_transparency = np.clip(local_colors + reflectance_colors, 0, 1)
+    without_reflectance = np.clip(local_colors + transparency * transparency_colors, 0, 1)
+    excess = (transparency * transparency_scales * transparency_excess + reflectance_scales * reflectance_excess +
+              (transparency_scales - 1) * (colors - without_transparency) +
+              (reflectance_scales - 1) * (colors - without_reflectance))
+    return colors, excess
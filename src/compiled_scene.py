@@ -0,0 +1,171 @@
+import numpy as np
+from surfaces.cube import intersectBoxes, boxNormals
+from surfaces.infinite_plane import intersectPlanes
+from surfaces.sphere import intersectSpheres, sphereNormals
+
+# Columns of the material table
+MATERIAL_DIFFUSE = slice(0, 3)
+MATERIAL_SPECULAR = slice(3, 6)
+MATERIAL_REFLECTION = slice(6, 9)
+MATERIAL_SHININESS = 9
+MATERIAL_TRANSPARENCY = 10
+MATERIAL_COLUMNS = 11
+
+# Columns of the light table
+LIGHT_POSITION = slice(0, 3)
+LIGHT_COLOR = slice(3, 6)
+LIGHT_SPECULAR_INTENSITY = 6
+LIGHT_SHADOW_INTENSITY = 7
+LIGHT_RADIUS = 8
+LIGHT_COLUMNS = 9
+
+# Surface types stored in the surface type array
+SURFACE_SPHERE = 0
+SURFACE_BOX = 1
+SURFACE_PLANE = 2
+
+# Maximum number of primitives intersected together with a batch of rays, bounds the (N, M) temporaries
+PRIMITIVES_CHUNK = 64
+
+
+# Structure of arrays form of a scene. Every primitive type is kept in contiguous arrays, and each primitive
+# keeps its index in the original surfaces list (its surface id) so results match the list based functions.
+# Material ids are zero based rows of the material table.
+class CompiledScene:
+    def __init__(self, sphere_centers, sphere_radii, sphere_ids, box_min, box_max, box_ids,
+                 plane_normals, plane_offsets, plane_ids, surface_types, surface_type_indices, surface_materials,
+                 material_table, light_table):
+        self.sphere_centers = sphere_centers
+        self.sphere_radii = sphere_radii
+        self.sphere_ids = sphere_ids
+        self.box_min = box_min
+        self.box_max = box_max
+        self.box_ids = box_ids
+        self.plane_normals = plane_normals
+        self.plane_offsets = plane_offsets
+        self.plane_ids = plane_ids
+        self.surface_types = surface_types
+        self.surface_type_indices = surface_type_indices
+        self.surface_materials = surface_materials
+        self.material_table = material_table
+        self.light_table = light_table
+
+    # Get functions
+    def getSphereCenters(self):
+        return self.sphere_centers
+
+    def getSphereRadii(self):
+        return self.sphere_radii
+
+    def getSphereIds(self):
+        return self.sphere_ids
+
+    def getBoxMin(self):
+        return self.box_min
+
+    def getBoxMax(self):
+        return self.box_max
+
+    def getBoxIds(self):
+        return self.box_ids
+
+    def getPlaneNormals(self):
+        return self.plane_normals
+
+    def getPlaneOffsets(self):
+        return self.plane_offsets
+
+    def getPlaneIds(self):
+        return self.plane_ids
+
+    def getSurfaceTypes(self):
+        return self.surface_types
+
+    def getSurfaceTypeIndices(self):
+        return self.surface_type_indices
+
+    def getSurfaceMaterials(self):
+        return self.surface_materials
+
+    def getMaterialTable(self):
+        return self.material_table
+
+    def getLightTable(self):
+        return self.light_table
+
+    def getNumberOfSurfaces(self):
+        return len(self.surface_types)
+
+    # Normals of N rays hitting the given surfaces, like surface.getNormal(ray) (the cube normal depends on the
+    # base point of the ray). surface_ids is (N,), ray_bases and hit_points are (N, 3)
+    def findNormals(self, surface_ids, ray_bases, hit_points):
+        normals = np.zeros((len(surface_ids), 3))
+        types = self.surface_types[surface_ids]
+        indices = self.surface_type_indices[surface_ids]
+
+        spheres = types == SURFACE_SPHERE
+        normals[spheres] = sphereNormals(self.sphere_centers[indices[spheres]], hit_points[spheres])
+
+        boxes = types == SURFACE_BOX
+        box_min = self.box_min[indices[boxes]]
+        box_max = self.box_max[indices[boxes]]
+        normals[boxes] = boxNormals((box_min + box_max) * 0.5, (box_max - box_min) * 0.5, ray_bases[boxes])
+
+        planes = types == SURFACE_PLANE
+        normals[planes] = self.plane_normals[indices[planes]]
+        return normals
+
+    # Intersect N rays with a single surface, returns (N,) t values like its findIntersection
+    def intersectSurface(self, surface_id, base_points, ray_directions):
+        surface_type = self.surface_types[surface_id]
+        index = self.surface_type_indices[surface_id]
+        if surface_type == SURFACE_SPHERE:
+            t = intersectSpheres(self.sphere_centers[index:index + 1], self.sphere_radii[index:index + 1],
+                                 base_points, ray_directions)
+        elif surface_type == SURFACE_BOX:
+            t = intersectBoxes(self.box_min[index:index + 1], self.box_max[index:index + 1],
+                               base_points, ray_directions)
+        else:
+            t = intersectPlanes(self.plane_normals[index:index + 1], self.plane_offsets[index:index + 1],
+                                base_points, ray_directions)
+        return t[:, 0]
+
+
+# Merge (N, M) intersection t values of M primitives with surface ids (M,) sorted in increasing order into the
+# closest hits found so far. Only positive t values count, equal ties go to the lowest surface id
+def mergeClosestHits(intersect_t, intersect_id, t, ids):
+    # Find the closest positive intersection of each ray
+    t = np.where(t > 0, t, np.inf)
+    closest = np.argmin(t, axis=1)
+    t = t[np.arange(len(t)), closest]
+    closest_ids = ids[closest]
+
+    # Found closer intersection points?
+    closer = (t < intersect_t) | ((t == intersect_t) & (closest_ids < intersect_id) & (t != np.inf))
+    intersect_t = np.where(closer, t, intersect_t)
+    intersect_id = np.where(closer, closest_ids, intersect_id)
+    return intersect_t, intersect_id
+
+
+# Material table of a materials list, one row per material
+def compileMaterials(materials):
+    material_table = np.zeros((len(materials), MATERIAL_COLUMNS))
+    for i, material in enumerate(materials):
+        material_table[i, MATERIAL_DIFFUSE] = material.getDiffuseColor()
+        material_table[i, MATERIAL_SPECULAR] = material.getSpecularColor()
+        material_table[i, MATERIAL_REFLECTION] = material.getReflectionColor()
+        material_table[i, MATERIAL_SHININESS] = material.getShininess()
+        material_table[i, MATERIAL_TRANSPARENCY] = material.getTransparency()
+    return material_table
+
+
+# Light table of a lights list, one row per light
+def compileLights(lights):
+    light_table = np.zeros((len(lights), LIGHT_COLUMNS))
+    for i, light in enumerate(lights):
+        light_table[i, LIGHT_POSITION] = light.getPosition()
+        light_table[i, LIGHT_COLOR] = light.getColor()
+        light_table[i, LIGHT_SPECULAR_INTENSITY] = light.getSpecularIntensity()
+        light_table[i, LIGHT_SHADOW_INTENSITY] = light.getShadowIntensity()
+        light_table[i, LIGHT_RADIUS] = light.getRadius()
+    return light_table
@@ -0,0 +1,35 @@
+import numpy as np
+from PIL import Image
+
+# Channels of a cost map: rays spawned by the pixel (primary, reflection, transparency and shadow rays) and seconds
+# spent shading it
+COST_RAYS = 0
+COST_SECONDS = 1
+
+# Color ramp of the heatmaps, from the cheapest pixels (black) to the most expensive (white)
+HEAT_COLORS = np.array([[0, 0, 0], [128, 0, 160], [230, 40, 40], [255, 200, 0], [255, 255, 255]], dtype=float)
+
+# Width in pixels of the gap between the two heatmaps
+PANEL_GAP = 4
+
+
+# Map values to the color ramp, scaled so the largest value is white
+def heatColors(values):
+    largest = np.max(values)
+    scaled = values / largest if largest > 0 else np.zeros_like(values)
+    stops = np.linspace(0, 1, len(HEAT_COLORS))
+    return np.stack([np.interp(scaled, stops, HEAT_COLORS[:, channel]) for channel in range(3)], axis=-1)
+
+
+# Save a (height, width, 2) cost map. A .npy path gets the raw array, anything else gets an image of the rays
+# heatmap (left) next to the shading time heatmap (right)
+def saveCostMap(file_path, cost_array):
+    if file_path.endswith('.npy'):
+        np.save(file_path, cost_array)
+        return
+
+    height, width, _ = cost_array.shape
+    image_array = np.zeros((height, width * 2 + PANEL_GAP, 3))
+    image_array[:, :width] = heatColors(cost_array[:, :, COST_RAYS])
+    image_array[:, width + PANEL_GAP:] = heatColors(cost_array[:, :, COST_SECONDS])
+    Image.fromarray(np.uint8(image_array)).save(file_path)
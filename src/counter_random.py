@@ -0,0 +1,56 @@
+import numpy as np
+
+# Path codes of the child rays, a child path is parent path * 3 + the code. With the pixel and the bounce depth the
+# path is the key of the random numbers of a hit
+TRANSPARENCY_PATH = 1
+REFLECTION_PATH = 2
+
+# Keys of the random streams of a hit, every use of random numbers has its own
+SHADOW_STREAM = 1
+SELECTION_STREAM = 2
+ROULETTE_STREAM = 3
+
+# Constants of the splitmix64 mixing function
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+MIX_MULTIPLIER_1 = 0xBF58476D1CE4E5B9
+MIX_MULTIPLIER_2 = 0x94D049BB133111EB
+MASK_64 = (1 << 64) - 1
+
+
+# splitmix64 finalizer of uint64 arrays, a bijection which scrambles all the bits
+def mixBits(values):
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(MIX_MULTIPLIER_1)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(MIX_MULTIPLIER_2)
+    return values ^ (values >> np.uint64(31))
+
+
+# The same on a python int, numpy scalars are much slower
+def mixInt(value):
+    value = ((value ^ (value >> 30)) * MIX_MULTIPLIER_1) & MASK_64
+    value = ((value ^ (value >> 27)) * MIX_MULTIPLIER_2) & MASK_64
+    return value ^ (value >> 31)
+
+
+# Hash a sequence of integer keys (or arrays of them, which are broadcast together) to uint64 values, an int if all
+# the keys are scalars. A prefix of keys can be hashed once and passed as the first key of a longer sequence
+def hashKeys(*keys):
+    if all(isinstance(key, (int, np.integer)) for key in keys):
+        value = 0
+        for key in keys:
+            value = mixInt(value ^ ((int(key) + GOLDEN_GAMMA) & MASK_64))
+        return value
+
+    hashes = np.uint64(0)
+    with np.errstate(over='ignore'):
+        for key in keys:
+            hashes = mixBits(hashes ^ (np.asarray(key).astype(np.uint64) + np.uint64(GOLDEN_GAMMA)))
+    return hashes
+
+
+# Counter based random numbers: uniform floats in [0, 1) which only depend on their keys, so any subset of them can be
+# drawn in any order, in any process, and come out the same. Arrays of keys give arrays of numbers
+def counterRandom(*keys):
+    hashes = hashKeys(*keys)
+    if isinstance(hashes, int):
+        return (hashes >> 11) * (1.0 / (1 << 53))
+    return (hashes >> np.uint64(11)) * (1.0 / (1 << 53))
@@ -0,0 +1,109 @@
+import struct
+import zlib
+import numpy as np
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color type of 8 bit RGB images, and the row filter written before every row (none)
+PNG_COLOR_RGB = 2
+PNG_FILTER_NONE = b'\x00'
+
+# Compressed bytes collected before they are written as an IDAT chunk
+PNG_CHUNK_SIZE = 1 << 20
+
+
+# Writes an 8 bit RGB PNG file a few rows at a time, so the whole image never has to be in memory
+class PngStreamWriter:
+    def __init__(self, file_path, width, height):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj()
+        self.pending = []
+        self.pending_size = 0
+        self.file = open(file_path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        self.writeChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, PNG_COLOR_RGB, 0, 0, 0))
+
+    def writeChunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    # Write the next (rows, width, 3) uint8 rows of the image
+    def writeRows(self, rows):
+        for row in rows:
+            compressed = self.compressor.compress(PNG_FILTER_NONE + row.tobytes())
+            self.pending.append(compressed)
+            self.pending_size += len(compressed)
+        self.rows_written += len(rows)
+        if self.pending_size >= PNG_CHUNK_SIZE:
+            self.writeChunk(b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def close(self):
+        if self.rows_written != self.height:
+            raise ValueError("PNG has {} rows, {} were written".format(self.height, self.rows_written))
+        self.pending.append(self.compressor.flush())
+        self.writeChunk(b'IDAT', b''.join(self.pending))
+        self.writeChunk(b'IEND', b'')
+        self.file.close()
+
+
+# Framebuffer which keeps the image as uint8 and streams every finished band of tile rows to a PNG file.
+# In memory only the bands which are not written yet are kept: renderImage gives no tile more than a band per worker
+# after the oldest unfinished one, so that is about workers + 1 bands (workers x band size) however slow a tile is.
+# With a file path the whole image is a memory mapped file instead (so it is on disk and can be read back after the
+# render)
+class StreamingFramebuffer:
+    def __init__(self, output_image, width, height, tile_size, file_path=None):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.tiles_per_band = -(-width // tile_size)
+        self.number_of_bands = -(-height // tile_size)
+        self.writer = PngStreamWriter(output_image, width, height)
+        self.next_band = 0
+        self.finished_tiles = {}
+        self.bands = {}
+
+        self.image = None
+        if file_path is not None:
+            self.image = np.memmap(file_path, dtype=np.uint8, mode='w+', shape=(height, width, 3))
+
+    # Get functions
+    def getImage(self):
+        return self.image
+
+    def getTilesPerBand(self):
+        return self.tiles_per_band
+
+    def getBand(self, band):
+        y0 = band * self.tile_size
+        y1 = min(y0 + self.tile_size, self.height)
+        if self.image is not None:
+            return self.image[y0:y1]
+        if band not in self.bands:
+            self.bands[band] = np.zeros((y1 - y0, self.width, 3), dtype=np.uint8)
+        return self.bands[band]
+
+    # Store a rendered (y1 - y0, x1 - x0, 3) tile of colors in [0, 255], then write the bands which are finished
+    def addTile(self, tile, tile_array):
+        x0, y0, x1, y1 = tile
+        band = y0 // self.tile_size
+        self.getBand(band)[:, x0:x1] = np.uint8(tile_array)
+        self.finished_tiles[band] = self.finished_tiles.get(band, 0) + 1
+
+        # Bands have to be written in order
+        while self.finished_tiles.get(self.next_band, 0) == self.tiles_per_band:
+            self.writer.writeRows(self.getBand(self.next_band))
+            self.bands.pop(self.next_band, None)
+            del self.finished_tiles[self.next_band]
+            self.next_band += 1
+
+    def close(self):
+        self.writer.close()
+        if self.image is not None:
+            self.image.flush()
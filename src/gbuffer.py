@@ -0,0 +1,185 @@
+import hashlib
+import json
+import numpy as np
+from compiled_scene import MATERIAL_REFLECTION, MATERIAL_TRANSPARENCY
+from shading import findPhongColors
+from utilities import normalizeRows
+
+# Surface id of the pixels whose primary ray missed
+GBUFFER_MISS = -1
+
+# Margin of the light tests of a relight, whose phong colors are found again from the G-buffer and can differ from
+# the render's in the last bits
+RELIGHT_TOLERANCE = 1e-6
+
+
+# Primary hit data of every pixel of a render: t, surface id, oriented normal, hit position and material id, which
+# materials the paths of the pixel hit (primary and secondary rays) and its final color in [0, 255].
+# It also keeps the key of the scene it was rendered from and the material and light tables, so a relight can
+# check the geometry is the same and find what changed
+class GBuffer:
+    def __init__(self, t_values, surface_ids, normals, positions, material_ids, material_masks, colors,
+                 scene_key=None, material_table=None, light_table=None):
+        self.t_values = t_values
+        self.surface_ids = surface_ids
+        self.normals = normals
+        self.positions = positions
+        self.material_ids = material_ids
+        self.material_masks = material_masks
+        self.colors = colors
+        self.scene_key = scene_key
+        self.material_table = material_table
+        self.light_table = light_table
+
+    # Get functions
+    def getTValues(self):
+        return self.t_values
+
+    def getSurfaceIds(self):
+        return self.surface_ids
+
+    def getNormals(self):
+        return self.normals
+
+    def getPositions(self):
+        return self.positions
+
+    def getMaterialIds(self):
+        return self.material_ids
+
+    def getMaterialMasks(self):
+        return self.material_masks
+
+    def getColors(self):
+        return self.colors
+
+    def getSceneKey(self):
+        return self.scene_key
+
+    def getMaterialTable(self):
+        return self.material_table
+
+    def getLightTable(self):
+        return self.light_table
+
+    # The part of the G-buffer covered by a tile (x0, y0, x1, y1), as a copy
+    def getTile(self, tile):
+        x0, y0, x1, y1 = tile
+        return GBuffer(*(array[y0:y1, x0:x1].copy() for array in self.getPixelArrays()))
+
+    def setTile(self, tile, tile_gbuffer):
+        x0, y0, x1, y1 = tile
+        for array, tile_array in zip(self.getPixelArrays(), tile_gbuffer.getPixelArrays()):
+            array[y0:y1, x0:x1] = tile_array
+
+    # Record the primary hits of (rows, cols) pixels, the normals are oriented against the rays like calculateColor
+    # does. Their material masks start from the primary material
+    def recordHits(self, rows, cols, compiled_scene, ray_bases, ray_directions, t_values, surface_ids):
+        hit_points = ray_bases + t_values[:, np.newaxis] * ray_directions
+        normals = compiled_scene.findNormals(surface_ids, ray_bases, hit_points)
+        facing = np.einsum('ij,ij->i', normals, ray_directions) > 0
+        normals[facing] = -normals[facing]
+        material_ids = compiled_scene.getSurfaceMaterials()[surface_ids]
+
+        self.t_values[rows, cols] = t_values
+        self.surface_ids[rows, cols] = surface_ids
+        self.normals[rows, cols] = normalizeRows(normals)
+        self.positions[rows, cols] = hit_points
+        self.material_ids[rows, cols] = material_ids
+        self.material_masks[rows, cols] = False
+        self.material_masks[rows, cols, material_ids] = True
+
+    def getPixelArrays(self):
+        return [self.t_values, self.surface_ids, self.normals, self.positions, self.material_ids,
+                self.material_masks, self.colors]
+
+    # Save as .npz, the material masks are packed to bits
+    def save(self, file_path):
+        np.savez(file_path, t_values=self.t_values, surface_ids=self.surface_ids, normals=self.normals,
+                 positions=self.positions, material_ids=self.material_ids,
+                 material_masks=np.packbits(self.material_masks, axis=-1), colors=self.colors,
+                 scene_key=self.scene_key, material_table=self.material_table, light_table=self.light_table)
+
+
+def loadGBuffer(file_path):
+    with np.load(file_path) as data:
+        material_table = data['material_table']
+        material_masks = np.unpackbits(data['material_masks'], axis=-1, count=len(material_table)).astype(bool)
+        return GBuffer(data['t_values'], data['surface_ids'], data['normals'], data['positions'],
+                       data['material_ids'], material_masks, data['colors'], str(data['scene_key']), material_table,
+                       data['light_table'])
+
+
+# Empty G-buffer of a (height, width) image of a scene with the given number of materials
+def createGBuffer(width, height, number_of_materials, scene_key=None, material_table=None, light_table=None):
+    return GBuffer(np.full((height, width), np.inf), np.full((height, width), GBUFFER_MISS),
+                   np.zeros((height, width, 3)), np.zeros((height, width, 3)), np.full((height, width), GBUFFER_MISS),
+                   np.zeros((height, width, number_of_materials), dtype=bool), np.zeros((height, width, 3)),
+                   scene_key, material_table, light_table)
+
+
+# Key of everything a relight can not change: camera, settings, geometry and material assignment of the surfaces,
+# resolution and the rendering options
+def findSceneKey(camera, scene_settings, compiled_scene, width, height, options):
+    digest = hashlib.sha256()
+    for array in [camera.getPosition(), camera.getLookAt(), camera.getUp(), camera.getScreenDistance(),
+                  camera.getScreenWidth(), scene_settings.getBackgroundColor(), scene_settings.getShadowRays(),
+                  scene_settings.getMaxRecursions(), compiled_scene.getSphereCenters(), compiled_scene.getSphereRadii(),
+                  compiled_scene.getBoxMin(), compiled_scene.getBoxMax(), compiled_scene.getPlaneNormals(),
+                  compiled_scene.getPlaneOffsets(), compiled_scene.getSurfaceTypes(),
+                  compiled_scene.getSurfaceMaterials(), len(compiled_scene.getMaterialTable()),
+                  len(compiled_scene.getLightTable())]:
+        digest.update(np.ascontiguousarray(array, dtype=float).tobytes())
+    digest.update(json.dumps([width, height, options], sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+# (height, width) mask of the pixels which have to be shaded again when the G-buffer's scene changes to the
+# compiled scene. A material change only changes the pixels whose paths hit the material, unless its transparency
+# changed and shadows go through transparent surfaces. A light change only changes the pixels it lights (see
+# findLightChangePixels), the primary rays came from camera_position and light_threshold is the render's
+def findRelightPixels(gbuffer, compiled_scene, transparent_shadows, camera_position, light_threshold=0.0):
+    hits = gbuffer.getSurfaceIds() != GBUFFER_MISS
+    old_materials = gbuffer.getMaterialTable()
+    new_materials = compiled_scene.getMaterialTable()
+    changed = np.any(old_materials != new_materials, axis=1)
+    transparency_changed = old_materials[:, MATERIAL_TRANSPARENCY] != new_materials[:, MATERIAL_TRANSPARENCY]
+    if transparent_shadows and np.any(transparency_changed):
+        return hits
+    relight_pixels = hits & np.any(gbuffer.getMaterialMasks()[:, :, changed], axis=-1)
+
+    old_lights = gbuffer.getLightTable()
+    new_lights = compiled_scene.getLightTable()
+    changed_lights = np.any(old_lights != new_lights, axis=1)
+    if np.any(changed_lights):
+        relight_pixels |= findLightChangePixels(gbuffer, hits, new_materials, old_lights[changed_lights],
+                                                new_lights[changed_lights], camera_position, light_threshold)
+    return relight_pixels
+
+
+# Mask of the hit pixels a change of some lights can change, old_lights and new_lights are their rows before and
+# after it. Only the primary hit is known, so every pixel whose path has secondary hits (it hit other materials, or
+# its material is transparent or reflective) is shaded again. At the others, a light changes nothing if before and
+# after the change it is behind the surface, or culled by the light threshold, so it was never looked at
+def findLightChangePixels(gbuffer, hits, material_table, old_lights, new_lights, camera_position, light_threshold):
+    rows, cols = np.nonzero(hits)
+    material_rows = material_table[gbuffer.getMaterialIds()[rows, cols]]
+    changed_pixels = ((np.count_nonzero(gbuffer.getMaterialMasks()[rows, cols], axis=-1) > 1) |
+                      (material_rows[:, MATERIAL_TRANSPARENCY] > 0) |
+                      np.any(material_rows[:, MATERIAL_REFLECTION] != 0, axis=-1))
+
+    # Phong colors of the lights at the primary hits, lights at grazing angles count as lit either way
+    positions = gbuffer.getPositions()[rows, cols]
+    normals = gbuffer.getNormals()[rows, cols]
+    ray_directions = normalizeRows(positions - camera_position)
+    for light_table in [old_lights, new_lights]:
+        colors, _, light_directions = findPhongColors(material_rows, light_table, positions, normals, ray_directions)
+        dots = np.einsum('nlk,nk->nl', light_directions, normals)
+        reached = dots >= -RELIGHT_TOLERANCE
+        if light_threshold > 0:
+            reached &= (np.max(colors, axis=-1) >= light_threshold - RELIGHT_TOLERANCE) | (dots < RELIGHT_TOLERANCE)
+        changed_pixels |= np.any(reached, axis=-1)
+
+    pixels = np.zeros(hits.shape, dtype=bool)
+    pixels[rows, cols] = changed_pixels
+    return pixels
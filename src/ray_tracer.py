@@ -1,130 +1,39 @@
 import argparse
+import copy
 from PIL import Image
 import numpy as np
 import time
-from camera import Camera
-from light import Light
-from material import Material
-from scene_settings import SceneSettings
-from ray import Ray
-from color_finder import ColorFinder
-from surfaces.cube import Cube
-from surfaces.infinite_plane import InfinitePlane
-from surfaces.sphere import Sphere
+from scene_loader import loadScene, hashSceneFile
+from bvh import BVH
+from tile_renderer import RenderContext, renderImage, splitTiles
+from render_stats import stats, timed
+from cost_map import saveCostMap
+from framebuffer import StreamingFramebuffer
+from checkpoint import RenderCheckpoint
+from screen_bins import ScreenBins
+from gbuffer import createGBuffer, loadGBuffer, findSceneKey, findRelightPixels
+from color_finder import SHADOW_PROBE_POSITIONS
 from utilities import *
 
+# Options which change the rendered image, a checkpoint can only be resumed (and a G-buffer relit) with the same
+# values
+RENDER_OPTIONS = ['t', 'wavefront', 'shadow_probes', 'shadow_tolerance', 'min_weight', 'russian_roulette',
+                  'shadow_epsilon', 'light_threshold', 'light_samples', 'crop', 'preview']
 
-def parse_scene_file(file_path):
-    # Set the precision for decimal calculations
-    surfaces = []
-    lights = []
-    materials = []
-    camera = None
-    scene_settings = None
-    with open(file_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            parts = line.split()
-            obj_type = parts[0]
-            params = [p for p in parts[1:]]
-            if obj_type == "cam":
-                object_params = {
-                    'position': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'look_at': np.array([float(params[3]), float(params[4]), float(params[5])]),
-                    'up_vector': np.array([float(params[6]), float(params[7]), float(params[8])]),
-                    'screen_distance': float(params[9]),
-                    'screen_width': float(params[10])
-                }
-
-                # Create camera
-                camera = Camera(object_params['position'], object_params['look_at'],
-                                object_params['up_vector'], object_params['screen_distance'],
-                                object_params['screen_width'])
-
-            elif obj_type == "set":
-                # Parse general settings parameters
-                object_params = {
-                    'background_color': np.array([float(params[0]), float(params[1]), float(params[2])],
-                                                 ),
-                    'root_number_shadow_rays': int(params[3]),
-                    'max_recursions': int(params[4])
-                }
-
-                # Create scene_settings
-                scene_settings = SceneSettings(object_params['background_color'],
-                                               object_params['root_number_shadow_rays'],
-                                               object_params['max_recursions'])
-            elif obj_type == "mtl":
-                # Parse material
-                object_params = {
-                    'diffuse_color': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'specular_color': np.array([float(params[3]), float(params[4]), float(params[5])],
-                                               ),
-                    'reflection_color': np.array([float(params[6]), float(params[7]), float(params[8])],
-                                                 ),
-                    'shininess': float(params[9]),
-                    'transparency': float(params[10])
-                }
-
-                # Create material
-                material = Material(object_params['diffuse_color'], object_params['specular_color'],
-                                    object_params['reflection_color'],
-                                    object_params['shininess'], object_params['transparency'])
-                materials.append(material)
-            elif obj_type == "sph":
-                object_params = {
-                    'position': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'radius': float(params[3]),
-                    'material_index': int(params[4])
-                }
-
-                # Create sphere
-                sphere = Sphere(object_params['position'], object_params['radius'], object_params['material_index'])
-                surfaces.append(sphere)
-            elif obj_type == "pln":
-                object_params = {
-                    'normal': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'offset': float(params[3]),
-                    'material_index': int(params[4])
-                }
-
-                # Create plane
-                plane = InfinitePlane(object_params['normal'], object_params['offset'],
-                                      object_params['material_index'])
-                surfaces.append(plane)
-            elif obj_type == "box":
-                # Parse box parameters
-                object_params = {
-                    'position': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'scale': float(params[3]),
-                    'material_index': int(params[4])
-                }
-
-                # Create box
-                cube = Cube(object_params['position'], object_params['scale'], object_params['material_index'])
-                surfaces.append(cube)
-            elif obj_type == "lgt":
-                # Parse light parameters
-                object_params = {
-                    'position': np.array([float(params[0]), float(params[1]), float(params[2])]),
-                    'color': np.array([float(params[3]), float(params[4]), float(params[5])]),
-                    'specular_intensity': float(params[6]),
-                    'shadow_intensity': float(params[7]),
-                    'radius': float(params[8])
-                }
-
-                # Create light
-                light = Light(object_params['position'], object_params['color'],
-                              object_params['specular_intensity'], object_params['shadow_intensity'],
-                              object_params['radius'])
-                lights.append(light)
-            else:
-                raise ValueError("Unknown object type: {}".format(obj_type))
-    return camera, scene_settings, surfaces, materials, lights
+# Default factor of --preview: the resolution, shadow rays and recursion depth are divided by it
+PREVIEW_FACTOR = 4
 
+# Resolution divisors of the first stages of a progressive render
+PROGRESSIVE_DIVISORS = [8, 4, 2]
 
+# Tile size of the refinement stages of a progressive render with one shadow ray and one bounce, smaller for more
+# shadow rays and bounces so every tile costs about the same. The budget is checked between tiles, so small tiles
+# stop the render soon after it runs out
+PROGRESSIVE_TILE_SIZE = 16
+PROGRESSIVE_MIN_TILE_SIZE = 4
+
+
+@timed('save_image')
 def save_image(output_image, image_array):
     # Save the uint8 image as a PNG file
     image = Image.fromarray(np.uint8(image_array))
@@ -133,6 +42,100 @@ def save_image(output_image, image_array):
     image.save(output_image)
 
 
+# Resize a (height, width, 3) image of colors in [0, 255] to the given size, with bilinear interpolation. If box, an
+# (x0, y0, x1, y1) window in pixel units (not necessarily whole pixels) is given, only that part of the image is resized
+def upsample_image(image_array, width, height, box=None):
+    image = Image.fromarray(np.uint8(image_array)).resize((width, height), Image.BILINEAR, box=box)
+    return np.asarray(image, dtype=float)
+
+
+# Window of a preview frame of preview_width x preview_height pixels which covers the (x0, y0, x1, y1) crop window
+# of the width x height frame, with a pixel more on every side for the interpolation at its edges
+def find_preview_crop(crop, width, height, preview_width, preview_height):
+    return [max(crop[0] * preview_width // width - 1, 0), max(crop[1] * preview_height // height - 1, 0),
+            min(-(-crop[2] * preview_width // width) + 1, preview_width),
+            min(-(-crop[3] * preview_height // height) + 1, preview_height)]
+
+
+# Upsample the preview render of the preview_crop window to exactly the crop window of the width x height frame, so
+# the preview lines up with the full render of the crop: the part of the render the crop window stands for (in
+# fractions of preview pixels) is resized to the window
+def upsample_preview(image_array, preview_crop, crop, width, height, preview_width, preview_height):
+    scale_x, scale_y = preview_width / width, preview_height / height
+    box = (crop[0] * scale_x - preview_crop[0], crop[1] * scale_y - preview_crop[1],
+           crop[2] * scale_x - preview_crop[0], crop[3] * scale_y - preview_crop[1])
+    return upsample_image(image_array, crop[2] - crop[0], crop[3] - crop[1], box)
+
+
+# Stages of a progressive render as (resolution divisor, shadow rays, max recursions): first more pixels with one
+# shadow ray and one bounce, then more shadow rays, then deeper bounces, doubling every time. The last stage is the
+# full render
+def find_progressive_stages(shadow_rays, max_recursions):
+    def doublings(last):
+        values = [1]
+        while values[-1] < last:
+            values.append(min(values[-1] * 2, last))
+        return values
+
+    first_recursions = min(1, max_recursions)
+    stages = [(divisor, 1, first_recursions) for divisor in PROGRESSIVE_DIVISORS]
+    stages += [(1, rays, first_recursions) for rays in doublings(shadow_rays)]
+    stages += [(1, shadow_rays, recursions) for recursions in doublings(max_recursions)[1:]]
+    return stages
+
+
+# Tile size of a refinement stage of a progressive render, see PROGRESSIVE_TILE_SIZE
+def find_progressive_tile_size(tile_size, shadow_rays, max_recursions):
+    stage_tile_size = int(PROGRESSIVE_TILE_SIZE / (shadow_rays * np.sqrt(max(max_recursions, 1))))
+    return min(tile_size, max(stage_tile_size, PROGRESSIVE_MIN_TILE_SIZE))
+
+
+# Render the stages of a progressive render one after the other, saving the image of every finished stage (upsampled
+# to the full size) to the output image, until the last stage is done or the time budget in seconds runs out.
+# The first stage always finishes, so there is an image however short the budget, the others are rendered in small
+# tiles so the render stops soon after the budget runs out
+def render_progressive(context, output_image, time_budget, workers=1, tile_size=64):
+    start_time = time.perf_counter()
+    deadline = start_time + time_budget
+    width = context.getWidth()
+    height = context.getHeight()
+    scene_settings = context.getSceneSettings()
+    stages = find_progressive_stages(scene_settings.getShadowRays(), scene_settings.getMaxRecursions())
+
+    for index, (divisor, shadow_rays, max_recursions) in enumerate(stages):
+        stage_settings = copy.copy(scene_settings)
+        stage_settings.setShadowRays(shadow_rays)
+        stage_settings.setMaxRecursions(max_recursions)
+        stage_context = copy.copy(context)
+        stage_context.setSceneSettings(stage_settings)
+        stage_context.setWidth(-(-width // divisor))
+        stage_context.setHeight(-(-height // divisor))
+        if divisor > 1:
+            # The screen bins are made for the full resolution
+            stage_context.setScreenBins(None)
+
+        stage_start_time = time.perf_counter()
+        if index == 0:
+            image_array, _ = renderImage(stage_context, workers, tile_size)
+        else:
+            image_array, _ = renderImage(stage_context, workers,
+                                         find_progressive_tile_size(tile_size, shadow_rays, max_recursions),
+                                         deadline=deadline)
+        if image_array is None:
+            print("Time budget ran out during stage {}/{}, stopped after {:.1f} seconds".format(
+                index + 1, len(stages), time.perf_counter() - start_time))
+            return
+        if divisor > 1:
+            image_array = upsample_image(image_array, width, height)
+        save_image(output_image, image_array)
+        print("Stage {}/{}: {}x{}, {} shadow rays, {} recursions, rendered in {:.1f} seconds, saved after {:.1f} "
+              "seconds".format(index + 1, len(stages), stage_context.getWidth(), stage_context.getHeight(),
+                               shadow_rays, max_recursions, time.perf_counter() - stage_start_time,
+                               time.perf_counter() - start_time))
+        if time.perf_counter() > deadline:
+            return
+
+
 def main():
     parser = argparse.ArgumentParser(description='Python Ray Tracer')
     parser.add_argument('scene_file', type=str, help='Path to the scene file')
@@ -141,7 +144,93 @@ def main():
     parser.add_argument('--height', type=int, default=500, help='Image height')
     parser.add_argument('-t', action='store_true', default=False, help='Consider transparency of objects in soft '
                                                                        'shadow process')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes rendering tiles in parallel')
+    parser.add_argument('--tile-size', type=int, default=64, help='Width and height of the rendered tiles')
+    parser.add_argument('--shadow-probes', type=int, default=0, help='Adaptive soft shadows: number of probe rays '
+                                                                         'per light (2 to 9) cast before the full '
+                                                                         'grid, 0 disables')
+    parser.add_argument('--shadow-tolerance', type=float, default=0.0, help='Adaptive soft shadows: largest '
+                                                                            'difference between probes that still '
+                                                                            'skips the full grid')
+    parser.add_argument('--wavefront', action='store_true', default=False, help='Trace reflection and transparency '
+                                                                                'rays breadth first, one batch per '
+                                                                                'bounce depth')
+    parser.add_argument('--min-weight', type=float, default=0.0, help='Terminate reflection and transparency paths '
+                                                                      'whose accumulated weight drops below this '
+                                                                      'value, 0 disables')
+    parser.add_argument('--russian-roulette', action='store_true', default=False, help='Continue paths below '
+                                                                                       '--min-weight with russian '
+                                                                                       'roulette instead of '
+                                                                                       'terminating them')
+    parser.add_argument('--shadow-epsilon', type=float, default=0.001, help='Shadow rays transmitting this much '
+                                                                            'light or less count as fully blocked')
+    parser.add_argument('--light-threshold', type=float, default=0.0, help='Skip lights whose color at a hit, before '
+                                                                           'shadows, is below this value in every '
+                                                                           'channel, 0 disables')
+    parser.add_argument('--light-samples', type=int, default=0, help='Cast shadow rays for only this many lights per '
+                                                                     'hit, picked at random by their contribution '
+                                                                     'and reweighted, 0 casts them for all lights')
+    parser.add_argument('--stats', type=str, nargs='?', const='', default=None, help='Print ray and timing '
+                                                                                      'statistics, or write them as '
+                                                                                      'JSON to the given path')
+    parser.add_argument('--cost-map', type=str, default=None, help='Save the rays spawned and shading time of every '
+                                                                    'pixel, as a heatmap (.png) or an array (.npy)')
+    parser.add_argument('--scene-cache', type=str, default=None, help='Directory of parsed scenes, keyed by the '
+                                                                       'hash of the scene file, so later renders '
+                                                                       'of the same scene skip parsing')
+    parser.add_argument('--stream', action='store_true', default=False, help='Keep the image as 8 bit colors and '
+                                                                             'write the finished rows to the output '
+                                                                             'PNG while rendering')
+    parser.add_argument('--framebuffer-file', type=str, default=None, help='With --stream, keep the image in this '
+                                                                           'memory mapped file instead of memory')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Keep the finished tiles in sidecar files with '
+                                                                     'this path prefix while rendering (default '
+                                                                     'with --resume: output image path + '
+                                                                     '.checkpoint)')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continue an interrupted render from '
+                                                                             'its checkpoint')
+    parser.add_argument('--save-gbuffer', type=str, default=None, help='Save the primary hits, materials and colors '
+                                                                       'of every pixel to this .npz file')
+    parser.add_argument('--relight', type=str, default=None, help='Reuse the G-buffer saved in this file by a render '
+                                                                  'of the same geometry and camera, shading again only '
+                                                                  'the pixels changed lights and materials affect')
+    parser.add_argument('--screen-bins', action='store_true', default=False, help='Bin the spheres and boxes by the '
+                                                                                  'screen tiles they project to, '
+                                                                                  'primary rays only test the '
+                                                                                  'surfaces of their tile')
+    parser.add_argument('--crop', type=int, nargs=4, default=None, metavar=('X0', 'Y0', 'X1', 'Y1'),
+                        help='Render only the pixels x0 <= x < x1, y0 <= y < y1 of the frame, as an image of that size')
+    parser.add_argument('--preview', type=int, nargs='?', const=PREVIEW_FACTOR, default=None, metavar='FACTOR',
+                        help='Render a quick preview: divide the resolution, shadow rays and recursion depth by the '
+                             'factor ({} by default) and upsample the image'.format(PREVIEW_FACTOR))
+    parser.add_argument('--time-budget', type=float, default=None, metavar='SECONDS',
+                        help='Render progressively, from a coarse pass to the full render, saving the image after '
+                             'every stage, and stop when the budget runs out')
     args = parser.parse_args()
+    if args.shadow_probes != 0 and not 2 <= args.shadow_probes <= len(SHADOW_PROBE_POSITIONS):
+        parser.error("--shadow-probes must be 0 or from 2 to {}".format(len(SHADOW_PROBE_POSITIONS)))
+    if args.time_budget is not None and (args.stream or args.checkpoint is not None or args.resume or
+                                         args.save_gbuffer is not None or args.relight is not None or
+                                         args.crop is not None or args.preview is not None or
+                                         args.cost_map is not None):
+        parser.error("--time-budget can not be used with --stream, checkpoints, G-buffers, --crop, --preview and "
+                     "--cost-map")
+    if args.crop is not None:
+        x0, y0, x1, y1 = args.crop
+        if not (0 <= x0 < x1 <= args.width and 0 <= y0 < y1 <= args.height):
+            parser.error("--crop must be a nonempty window of the {}x{} frame".format(args.width, args.height))
+    if args.crop is not None and (args.save_gbuffer is not None or args.relight is not None):
+        parser.error("--crop can not be used with --save-gbuffer and --relight")
+    if args.preview is not None:
+        if args.preview < 1:
+            parser.error("--preview factor must be at least 1")
+        if args.stream or args.checkpoint is not None or args.resume or args.save_gbuffer is not None or \
+                args.relight is not None:
+            parser.error("--preview can not be used with --stream, checkpoints, --save-gbuffer and --relight")
+    if args.framebuffer_file is not None and not args.stream:
+        parser.error("--framebuffer-file needs --stream")
+    if (args.save_gbuffer is not None or args.relight is not None) and (args.checkpoint is not None or args.resume):
+        parser.error("--save-gbuffer and --relight can not be used with checkpoints")
 
     print("Ray tracer starts running")
 
@@ -151,53 +240,110 @@ def main():
     # Parse the scene file
     width = args.width
     height = args.height
-    camera, scene_settings, surfaces, materials, lights = parse_scene_file(args.scene_file)
-
-    # Find pixels and the rays mapped to each pixel
-    pixels, rays_directions = findPixelRays(camera, width, height)
-
-    image_array = np.zeros((height, width, 3))
-    P_0 = camera.getPosition()
-
-    softshadow_func = hasIntersection
+    camera, scene_settings, surfaces, materials, lights, compiled_scene = loadScene(args.scene_file,
+                                                                                    args.scene_cache)
+    bvh = BVH(surfaces, compiled_scene)
+    scene_settings.setShadowProbes(args.shadow_probes)
+    scene_settings.setShadowTolerance(args.shadow_tolerance)
+    scene_settings.setMinWeight(args.min_weight)
+    scene_settings.setRussianRoulette(args.russian_roulette)
+    scene_settings.setShadowEpsilon(args.shadow_epsilon)
+    scene_settings.setLightThreshold(args.light_threshold)
+    scene_settings.setLightSamples(args.light_samples)
+
+    # Size of the output image, the crop window or the whole frame
+    crop = args.crop
+    output_width, output_height = (crop[2] - crop[0], crop[3] - crop[1]) if crop is not None else (width, height)
+    output_crop = crop if crop is not None else [0, 0, width, height]
+
+    # Preview: render a smaller frame (and the part of it covering the crop window) with fewer shadow rays and
+    # bounces, upsampled when saved
+    if args.preview is not None:
+        factor = args.preview
+        width, height = -(-width // factor), -(-height // factor)
+        if crop is not None:
+            crop = find_preview_crop(crop, args.width, args.height, width, height)
+        scene_settings.setShadowRays(max(1, scene_settings.getShadowRays() // factor))
+        scene_settings.setMaxRecursions(max(1, scene_settings.getMaxRecursions() // factor))
+        print("Preview at {}x{}, {} shadow rays, {} recursions".format(width, height, scene_settings.getShadowRays(),
+                                                                      scene_settings.getMaxRecursions()))
+
+    softshadow_func = hasIntersections
     if args.t:
-        softshadow_func = findTransparencyFactor
-
-    color_finder = ColorFinder(scene_settings, lights, surfaces, materials,
-                               scene_settings.getBackgroundColor(), softshadow_func)
-
-    for col in range(width):
-        for row in range(height):
-
-            # Default color if no intersection
-            color = np.zeros(3)
-            color += scene_settings.getBackgroundColor()
-
-            # Get direction
-            direction = rays_directions[row, col]
-            direction = normalize(direction)
-
-            # # Find intersection with each surfaces
-            t, surface = findIntersection(P_0, direction, surfaces)
-
-            # Their is intersection? calculate color
-            if t != np.inf:
-                material_index = surface.getMaterial() - 1
-                ray = Ray(camera.getPosition(), direction,
-                          camera.getPosition() + t * direction)
-                color = color_finder.calculateColor(ray, materials[material_index], surface,
-                                                    scene_settings.getMaxRecursions())
-
-            image_array[row, col, :] = (color[:] * 255.0)
+        softshadow_func = findTransparencyFactors
+
+    # Render the image tile by tile
+    context = RenderContext(camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh,
+                            softshadow_func, width, height)
+    context.setWavefront(args.wavefront)
+    context.setCostMap(args.cost_map is not None)
+    if crop is not None:
+        context.setCrop(tuple(crop))
+    if args.screen_bins:
+        context.setScreenBins(ScreenBins(camera, compiled_scene, bvh, width, height))
+
+    # G-buffer to relight from and to save
+    scene_key = findSceneKey(camera, scene_settings, compiled_scene, width, height,
+                             {option: getattr(args, option) for option in RENDER_OPTIONS})
+    gbuffer = None
+    if args.relight is not None:
+        relight_gbuffer = loadGBuffer(args.relight)
+        if relight_gbuffer.getSceneKey() != scene_key:
+            raise ValueError("G-buffer {} was rendered with a different camera, geometry, settings or options, can not "
+                             "relight".format(args.relight))
+        relight_pixels = findRelightPixels(relight_gbuffer, compiled_scene, args.t, camera.getPosition(),
+                                           args.light_threshold)
+        context.setRelight(relight_gbuffer, relight_pixels)
+        print("Relighting {} of {} pixels".format(np.count_nonzero(relight_pixels), width * height))
+    if args.save_gbuffer is not None:
+        context.setRecordGBuffer(True)
+        gbuffer = createGBuffer(width, height, len(materials), scene_key, compiled_scene.getMaterialTable(),
+                                compiled_scene.getLightTable())
+    framebuffer = None
+    if args.stream:
+        framebuffer = StreamingFramebuffer(args.output_image, output_width, output_height, args.tile_size,
+                                           args.framebuffer_file)
+    checkpoint = None
+    if args.checkpoint is not None or args.resume:
+        # Resuming is only allowed with the same scene and every option that changes the image
+        settings = {'scene': hashSceneFile(args.scene_file), 'width': width, 'height': height,
+                    'tile_size': args.tile_size}
+        for option in RENDER_OPTIONS:
+            settings[option] = getattr(args, option)
+        checkpoint = RenderCheckpoint(args.checkpoint or args.output_image + '.checkpoint', settings,
+                                      splitTiles(output_width, output_height, args.tile_size), args.resume)
+    if args.time_budget is not None:
+        # Every finished stage is saved to the output image
+        render_progressive(context, args.output_image, args.time_budget, args.workers, args.tile_size)
+        image_array, cost_array = None, None
+    else:
+        image_array, cost_array = renderImage(context, args.workers, args.tile_size, framebuffer, checkpoint,
+                                              gbuffer)
 
     # Save the output image
-    save_image(args.output_image, image_array)
+    if args.preview is not None:
+        image_array = upsample_preview(image_array, crop if crop is not None else [0, 0, width, height], output_crop,
+                                       args.width, args.height, width, height)
+    if framebuffer is not None:
+        framebuffer.close()
+    elif image_array is not None:
+        save_image(args.output_image, image_array)
+    if checkpoint is not None:
+        checkpoint.remove()
+    if gbuffer is not None:
+        gbuffer.save(args.save_gbuffer)
+    if cost_array is not None:
+        saveCostMap(args.cost_map, cost_array)
 
     # Display time it Took
     end_time = (time.time() - start_time) / 60.0
     minutes = "{:.2f}".format(end_time)
     print("Finished, total time in minutes: " + str(minutes))
 
+    # Report statistics
+    if args.stats is not None:
+        stats.writeReport(args.stats or None)
+
 
 if __name__ == '__main__':
     main()
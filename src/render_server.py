@@ -0,0 +1,234 @@
+import argparse
+import io
+import json
+import multiprocessing
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+from bvh import BVH
+from camera import Camera
+from ray_tracer import save_image
+from scene_loader import loadScene, hashSceneFile
+from tile_renderer import RenderContext, renderTile, splitTiles
+from utilities import hasIntersections, findTransparencyFactors
+
+# Scenes kept loaded by every process, the least recently used one is dropped past this. As many render contexts
+# (with their color finders) are kept
+MAX_CACHED_SCENES = 8
+
+# Fields of a render request which set up its render context, the requests with the same ones share it
+REQUEST_CONTEXT_FIELDS = ['width', 'height', 'transparency', 'camera']
+
+# Camera fields a render request may override
+CAMERA_FIELDS = ['position', 'look_at', 'up_vector', 'screen_distance', 'screen_width']
+
+# Camera fields which are 3D vectors, the others are numbers
+CAMERA_VECTOR_FIELDS = ['position', 'look_at', 'up_vector']
+
+# Tile size of the server renders
+SERVER_TILE_SIZE = 32
+
+
+# Loaded scenes (objects, compiled scene and BVH) keyed by the hash of the scene file, and the render contexts and
+# color finders of the requests on them keyed by the scene hash and the request's context fields, so the material
+# and light tables, shadow samples and occluder caches of a color finder are set up once for all its tiles
+class SceneCache:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.scenes = OrderedDict()
+        self.renderers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def setCacheDir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    # Returns camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh
+    def getScene(self, scene_file, scene_hash):
+        with self.lock:
+            if scene_hash in self.scenes:
+                self.scenes.move_to_end(scene_hash)
+                return self.scenes[scene_hash]
+
+            camera, scene_settings, surfaces, materials, lights, compiled_scene = loadScene(scene_file,
+                                                                                            self.cache_dir)
+            scene = (camera, scene_settings, surfaces, materials, lights, compiled_scene,
+                     BVH(surfaces, compiled_scene))
+            self.scenes[scene_hash] = scene
+            if len(self.scenes) > MAX_CACHED_SCENES:
+                self.scenes.popitem(last=False)
+            return scene
+
+    # Returns the render context and color finder of a request
+    def getRenderer(self, scene_file, scene_hash, request):
+        key = (scene_hash, json.dumps([request.get(field) for field in REQUEST_CONTEXT_FIELDS], sort_keys=True))
+        with self.lock:
+            if key in self.renderers:
+                self.renderers.move_to_end(key)
+                return self.renderers[key]
+
+        context = createRequestContext(self.getScene(scene_file, scene_hash), request)
+        renderer = (context, context.createColorFinder())
+        with self.lock:
+            self.renderers[key] = renderer
+            if len(self.renderers) > MAX_CACHED_SCENES:
+                self.renderers.popitem(last=False)
+        return renderer
+
+
+# Scenes of a worker process, loaded the first time a tile of them comes
+worker_scenes = SceneCache()
+
+
+def initServerWorker(cache_dir):
+    worker_scenes.setCacheDir(cache_dir)
+
+
+# Create the render context of a request: its resolution, transparency flag and camera overrides on a loaded scene
+def createRequestContext(scene, request):
+    camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh = scene
+    camera_fields = {'position': camera.getPosition(), 'look_at': camera.getLookAt(), 'up_vector': camera.getUp(),
+                     'screen_distance': camera.getScreenDistance(), 'screen_width': camera.getScreenWidth()}
+    for field, value in request.get('camera', {}).items():
+        if field not in CAMERA_FIELDS:
+            raise ValueError("Unknown camera field: {}".format(field))
+        camera_fields[field] = np.array(value, dtype=float) if np.ndim(value) else float(value)
+    request_camera = Camera(camera_fields['position'], camera_fields['look_at'], camera_fields['up_vector'],
+                            camera_fields['screen_distance'], camera_fields['screen_width'])
+
+    softshadow_func = findTransparencyFactors if request.get('transparency', False) else hasIntersections
+    return RenderContext(request_camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh,
+                         softshadow_func, request['width'], request['height'])
+
+
+# Check a number of a request, JSON booleans are not numbers
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# Check a decoded render request before any of its tiles go to the workers, raises ValueError on bad input. Returns
+# the request with its width and height as ints
+def validateRequest(request):
+    if not isinstance(request, dict):
+        raise ValueError("The request must be a JSON object")
+    if not isinstance(request.get('scene'), str):
+        raise ValueError("scene must be a path")
+    for field in ['width', 'height']:
+        value = request.get(field)
+        if not isNumber(value) or value != int(value) or value <= 0:
+            raise ValueError("{} must be a positive integer".format(field))
+    if not isinstance(request.get('transparency', False), bool):
+        raise ValueError("transparency must be a boolean")
+    if request.get('output') is not None and not isinstance(request['output'], str):
+        raise ValueError("output must be a path")
+
+    camera = request.get('camera', {})
+    if not isinstance(camera, dict):
+        raise ValueError("camera must be an object")
+    for field, value in camera.items():
+        if field not in CAMERA_FIELDS:
+            raise ValueError("Unknown camera field: {}".format(field))
+        if field in CAMERA_VECTOR_FIELDS:
+            if not isinstance(value, list) or len(value) != 3 or not all(isNumber(x) for x in value):
+                raise ValueError("camera {} must be a list of 3 numbers".format(field))
+        elif not isNumber(value):
+            raise ValueError("camera {} must be a number".format(field))
+    return dict(request, width=int(request['width']), height=int(request['height']))
+
+
+# Render one tile of a request in a worker
+def renderServerTile(job):
+    scene_file, scene_hash, request, tile = job
+    context, color_finder = worker_scenes.getRenderer(scene_file, scene_hash, request)
+    tile_array, _, _ = renderTile(context, color_finder, tile)
+    return tile, tile_array
+
+
+# Long running renderer: scenes stay loaded in the workers, and the tiles of all the requests being served share
+# one pool of worker processes
+class RenderServer:
+    def __init__(self, workers=1, cache_dir=None):
+        self.pool = multiprocessing.Pool(workers, initializer=initServerWorker, initargs=(cache_dir,))
+
+    # Render a request checked by validateRequest, returns the image as a (height, width, 3) array of colors in
+    # [0, 255]
+    def render(self, request):
+        scene_file = request['scene']
+        width = request['width']
+        height = request['height']
+
+        jobs = [(scene_file, hashSceneFile(scene_file), request, tile)
+                for tile in splitTiles(width, height, SERVER_TILE_SIZE)]
+        image_array = np.zeros((height, width, 3))
+        for (x0, y0, x1, y1), tile_array in self.pool.imap_unordered(renderServerTile, jobs):
+            image_array[y0:y1, x0:x1] = tile_array
+        return image_array
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# POST /render with a JSON request:
+# {"scene": path, "width": int, "height": int, "transparency": bool (optional),
+#  "camera": {any of position, look_at, up_vector, screen_distance, screen_width} (optional),
+#  "output": path (optional)}
+# Responds with the PNG image, or if an output path is given writes the image there and responds with JSON
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/render':
+            self.sendJson(404, {'error': "Unknown path: {}".format(self.path)})
+            return
+
+        try:
+            request = validateRequest(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+            image_array = self.server.renderer.render(request)
+        except (KeyError, ValueError, TypeError, OSError) as error:
+            self.sendJson(400, {'error': "{}: {}".format(type(error).__name__, error)})
+            return
+
+        if request.get('output'):
+            save_image(request['output'], image_array)
+            self.sendJson(200, {'output': request['output']})
+            return
+
+        image_bytes = io.BytesIO()
+        Image.fromarray(np.uint8(image_array)).save(image_bytes, format='PNG')
+        self.sendResponse(200, 'image/png', image_bytes.getvalue())
+
+    def sendJson(self, status, body):
+        self.sendResponse(status, 'application/json', json.dumps(body).encode())
+
+    def sendResponse(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ray tracer render server')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on')
+    parser.add_argument('--port', type=int, default=8000, help='Port the server listens on')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='Number of processes '
+                                                                                         'rendering tiles')
+    parser.add_argument('--scene-cache', type=str, default=None, help='Directory of parsed scenes, keyed by the '
+                                                                       'hash of the scene file')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), RenderRequestHandler)
+    server.renderer = RenderServer(args.workers, args.scene_cache)
+    print("Render server listening on http://{}:{}/render".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.renderer.close()
+
+
+if __name__ == '__main__':
+    main()
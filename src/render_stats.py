@@ -0,0 +1,115 @@
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+# Counters of rays and the hits among them, for the hit rates of the report
+RAY_COUNTERS = [('primary_rays', 'primary_hits'), ('reflection_rays', 'reflection_hits'),
+                ('transparency_rays', 'transparency_hits'), ('shadow_rays', 'shadow_rays_blocked')]
+
+# Counters of ray and surface intersection tests
+TEST_COUNTERS = ['sphere_tests', 'box_tests', 'plane_tests']
+
+# Counters of the lights shaded at hits: in front of the surface, culled by their contribution and left out by the
+# light sampling
+LIGHT_COUNTERS = ['lit_lights', 'culled_lights', 'unsampled_lights']
+
+
+# Ray counters and stage timers of a render. They are plain dict updates so they stay on all the time.
+# Every process keeps its own (the module level stats), workers send theirs back with each tile to be merged
+class RenderStats:
+    def __init__(self):
+        self.counters = {}
+        self.seconds = {}
+
+    # Get functions
+    def getCounters(self):
+        return self.counters
+
+    def getSeconds(self):
+        return self.seconds
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Number of rays of every kind counted so far
+    def countRays(self):
+        return sum(self.counters.get(rays, 0) for rays, _ in RAY_COUNTERS)
+
+    def addTime(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    # Time the block under the given name
+    @contextmanager
+    def measure(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start_time)
+
+    # Add the counters and timers of other stats (of a worker) to these
+    def merge(self, other):
+        for name, amount in other.getCounters().items():
+            self.count(name, amount)
+        for name, seconds in other.getSeconds().items():
+            self.addTime(name, seconds)
+
+    # Return a copy of the stats and start counting from zero
+    def collect(self):
+        collected = RenderStats()
+        collected.merge(self)
+        self.counters = {}
+        self.seconds = {}
+        return collected
+
+    def buildReport(self):
+        rates = {}
+        for rays, hits in RAY_COUNTERS:
+            if self.counters.get(rays, 0) > 0:
+                rates[hits + '_rate'] = self.counters.get(hits, 0) / self.counters[rays]
+        return {'counters': dict(sorted(self.counters.items())), 'rates': rates,
+                'seconds': dict(sorted(self.seconds.items()))}
+
+    def formatReport(self):
+        report = self.buildReport()
+        lines = ["Rays:"]
+        for rays, hits in RAY_COUNTERS:
+            lines.append("  {:<20}{:>14,}  {} {:.1%}".format(rays, self.counters.get(rays, 0), hits,
+                                                             report['rates'].get(hits + '_rate', 0.0)))
+        lines.append("Intersection tests:")
+        for tests in TEST_COUNTERS:
+            lines.append("  {:<20}{:>14,}".format(tests, self.counters.get(tests, 0)))
+        lines.append("Lights:")
+        for lights in LIGHT_COUNTERS:
+            lines.append("  {:<20}{:>14,}".format(lights, self.counters.get(lights, 0)))
+        lines.append("Time in seconds (nested stages are included in their callers, summed over workers):")
+        for name, seconds in report['seconds'].items():
+            lines.append("  {:<36}{:>10.3f}".format(name, seconds))
+        return "\n".join(lines)
+
+    # Print the report, or write it as JSON if a path is given
+    def writeReport(self, file_path=None):
+        if file_path is None:
+            print(self.formatReport())
+            return
+        with open(file_path, 'w') as f:
+            json.dump(self.buildReport(), f, indent=2)
+
+
+# Stats of this process
+stats = RenderStats()
+
+
+# Decorator which adds the time spent in the function to the stats of the process under the given name
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.addTime(name, time.perf_counter() - start_time)
+        return wrapper
+    return decorator
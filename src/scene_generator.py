@@ -0,0 +1,81 @@
+import argparse
+import numpy as np
+
+# Materials the generated surfaces pick from:
+# diffuse color, specular color, reflection color, phong, transparency
+GENERATED_MATERIALS = [
+    ([0.95, 0.07, 0.07], [1, 1, 1], [0.2, 0.1, 0.1], 30, 0),
+    ([0.07, 0.07, 0.95], [1, 1, 1], [0.1, 0.1, 0.2], 30, 0),
+    ([0.34, 0.95, 0.34], [1, 1, 1], [0.1, 0.2, 0.1], 30, 0.5),
+    ([0.95, 0.95, 0.07], [0.5, 0.5, 0.5], [0, 0, 0], 10, 0),
+    ([0, 0, 0], [1, 1, 1], [0.9, 0.9, 0.9], 100, 0),
+    ([0.8, 0.8, 0.8], [0.8, 0.8, 0.8], [0, 0, 0], 10, 0)
+]
+
+# The generated surfaces are scattered in a cube of this size in front of the camera, above the floor plane
+SCENE_SIZE = 10.0
+
+
+def formatNumbers(numbers):
+    return "\t".join("{:g}".format(number) for number in numbers)
+
+
+# Generate a scene file in the scene format with the given number of spheres, boxes and lights
+def generateScene(file_path, spheres, boxes, lights, shadow_rays, max_recursions, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # Surfaces get smaller as there are more of them, so dense scenes stay about as crowded
+    surface_size = SCENE_SIZE / max(np.cbrt(spheres + boxes), 1.0) * 0.4
+    floor_material = len(GENERATED_MATERIALS)
+
+    lines = ["# Generated scene: {} spheres, {} boxes, {} lights".format(spheres, boxes, lights),
+             "# Camera: \tpx\tpy\tpz\tlx\tly\tlz\tux\tuy\tuz\tsc_dist\tsc_width",
+             "cam\t" + formatNumbers([0, SCENE_SIZE * 0.6, -SCENE_SIZE * 1.6, 0, SCENE_SIZE * 0.3, 0, 0, 1, 0, 1, 1]),
+             "# Settings: \tbgr\tbgg\tbgb\tsh_rays\trec_max",
+             "set\t" + formatNumbers([1, 1, 1, shadow_rays, max_recursions]),
+             "# Material:\tdr\tdg\tdb\tsr\tsg\tsb\trr\trg\trb\tphong\ttrans"]
+    for diffuse, specular, reflection, phong, transparency in GENERATED_MATERIALS:
+        lines.append("mtl\t" + formatNumbers(diffuse + specular + reflection + [phong, transparency]))
+
+    lines.append("# Plane:\tnx\tny\tnz\toffset\tmat_idx")
+    lines.append("pln\t" + formatNumbers([0, 1, 0, 0, floor_material]))
+
+    lines.append("# Spheres:\tcx\tcy\tcz\tradius\tmat_idx")
+    for _ in range(spheres):
+        center = rng.uniform([-SCENE_SIZE / 2, 0, -SCENE_SIZE / 2], [SCENE_SIZE / 2, SCENE_SIZE, SCENE_SIZE / 2])
+        radius = rng.uniform(0.25, 0.5) * surface_size
+        lines.append("sph\t" + formatNumbers(list(center) + [radius, rng.integers(1, floor_material)]))
+
+    lines.append("# Cubes:\tcx\tcy\tcz\tedge\tmat_idx")
+    for _ in range(boxes):
+        center = rng.uniform([-SCENE_SIZE / 2, 0, -SCENE_SIZE / 2], [SCENE_SIZE / 2, SCENE_SIZE, SCENE_SIZE / 2])
+        edge = rng.uniform(0.5, 1.0) * surface_size
+        lines.append("box\t" + formatNumbers(list(center) + [edge, rng.integers(1, floor_material)]))
+
+    lines.append("# Lights:\tpx\tpy\tpz\tr\tg\tb\tspec\tshadow\twidth")
+    for _ in range(lights):
+        position = rng.uniform([-SCENE_SIZE, SCENE_SIZE * 1.2, -SCENE_SIZE], [SCENE_SIZE, SCENE_SIZE * 2, SCENE_SIZE])
+        color = np.full(3, 1.0 / lights)
+        lines.append("lgt\t" + formatNumbers(list(position) + list(color) + [1, 0.8, 1]))
+
+    with open(file_path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic scene file')
+    parser.add_argument('scene_file', type=str, help='Path of the generated scene file')
+    parser.add_argument('--spheres', type=int, default=100, help='Number of spheres')
+    parser.add_argument('--boxes', type=int, default=0, help='Number of boxes')
+    parser.add_argument('--lights', type=int, default=2, help='Number of lights')
+    parser.add_argument('--shadow-rays', type=int, default=3, help='Root number of shadow rays')
+    parser.add_argument('--recursions', type=int, default=3, help='Maximum number of recursions')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the surfaces placement')
+    args = parser.parse_args()
+
+    generateScene(args.scene_file, args.spheres, args.boxes, args.lights, args.shadow_rays, args.recursions,
+                  args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import numpy as np
+from camera import Camera
+from compiled_scene import CompiledScene, MATERIAL_COLUMNS, LIGHT_COLUMNS, SURFACE_SPHERE, SURFACE_BOX, SURFACE_PLANE
+from light import Light
+from material import Material
+from scene_settings import SceneSettings
+from surfaces.cube import Cube
+from surfaces.infinite_plane import InfinitePlane
+from surfaces.sphere import Sphere
+
+# Number of values of every record type of the scene format
+RECORD_COLUMNS = {'cam': 11, 'set': 5, 'mtl': MATERIAL_COLUMNS, 'sph': 5, 'pln': 5, 'box': 5, 'lgt': LIGHT_COLUMNS}
+
+# Surface type of the surface records, the order of the surfaces in the file is kept as a list of these
+SURFACE_RECORDS = {'sph': SURFACE_SPHERE, 'box': SURFACE_BOX, 'pln': SURFACE_PLANE}
+
+# Name of the array of the surface types (in file order) in the records and in the cache
+SURFACE_ORDER = 'order'
+
+# Bytes of the scene file hashed at a time
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# Parse the scene file into one (lines, columns) array per record type, plus the surface types in file order.
+# Lines are only grouped by record type, each group is then converted to floats in one step
+def parseSceneRecords(file_path):
+    groups = {record_type: [] for record_type in RECORD_COLUMNS}
+    surface_order = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if not parts or parts[0].startswith("#"):
+                continue
+            record_type = parts[0]
+            if record_type not in groups:
+                raise ValueError("Unknown object type: {}".format(record_type))
+            groups[record_type].append(parts[1] if len(parts) > 1 else "")
+            if record_type in SURFACE_RECORDS:
+                surface_order.append(SURFACE_RECORDS[record_type])
+
+    records = {SURFACE_ORDER: np.array(surface_order, dtype=np.int8)}
+    for record_type, lines in groups.items():
+        records[record_type] = parseGroup(lines, RECORD_COLUMNS[record_type])
+    return records
+
+
+# Convert the lines of one record type to a (lines, columns) array, a line with too few values is an error
+def parseGroup(lines, columns):
+    value_counts = [len(line.split()) for line in lines]
+    for line, count in zip(lines, value_counts):
+        if count < columns:
+            raise ValueError("Expected {} values, got {}: {}".format(columns, count, line.strip()))
+
+    # Every line has exactly the right number of values, convert them all at once
+    if all(count == columns for count in value_counts):
+        values = np.fromstring(" ".join(lines), sep=" ") if lines else np.zeros(0)
+        if values.size == len(lines) * columns:
+            return values.reshape(-1, columns)
+
+    # Lines with extra values (or values which are not numbers), parse them one by one
+    return np.array([[float(value) for value in line.split()[:columns]] for line in lines]).reshape(-1, columns)
+
+
+# Create the scene objects and the compiled scene from the record arrays, returns the camera, scene_settings,
+# surfaces, materials, lights and the compiled scene. The objects keep views of the record arrays
+def buildScene(records):
+    camera = None
+    if len(records['cam']):
+        cam = records['cam'][-1]
+        camera = Camera(cam[0:3].copy(), cam[3:6].copy(), cam[6:9].copy(), float(cam[9]), float(cam[10]))
+
+    scene_settings = None
+    if len(records['set']):
+        settings = records['set'][-1]
+        scene_settings = SceneSettings(settings[0:3].copy(), int(settings[3]), int(settings[4]))
+
+    materials = [Material(row[0:3], row[3:6], row[6:9], shininess, transparency)
+                 for row, shininess, transparency in zip(np.asarray(records['mtl']), records['mtl'][:, 9].tolist(),
+                                                         records['mtl'][:, 10].tolist())]
+    lights = [Light(row[0:3], row[3:6], specular, shadow, radius)
+              for row, specular, shadow, radius in zip(np.asarray(records['lgt']), records['lgt'][:, 6].tolist(),
+                                                       records['lgt'][:, 7].tolist(), records['lgt'][:, 8].tolist())]
+
+    # Surfaces of every type, then merged back into file order
+    spheres = records['sph']
+    sphere_objects = [Sphere(center, radius, material) for center, radius, material in
+                      zip(np.asarray(spheres[:, 0:3]), spheres[:, 3].tolist(), spheres[:, 4].astype(int).tolist())]
+    boxes = records['box']
+    box_objects = [Cube(center, scale, material) for center, scale, material in
+                   zip(np.asarray(boxes[:, 0:3]), boxes[:, 3].tolist(), boxes[:, 4].astype(int).tolist())]
+    planes = records['pln']
+    plane_objects = [InfinitePlane(normal, offset, material) for normal, offset, material in
+                     zip(np.asarray(planes[:, 0:3]), planes[:, 3].tolist(), planes[:, 4].astype(int).tolist())]
+
+    surface_types = np.asarray(records[SURFACE_ORDER], dtype=np.int8)
+    sphere_ids = np.flatnonzero(surface_types == SURFACE_SPHERE)
+    box_ids = np.flatnonzero(surface_types == SURFACE_BOX)
+    plane_ids = np.flatnonzero(surface_types == SURFACE_PLANE)
+    surfaces = [None] * len(surface_types)
+    for ids, objects in ((sphere_ids, sphere_objects), (box_ids, box_objects), (plane_ids, plane_objects)):
+        for surface_id, surface in zip(ids.tolist(), objects):
+            surfaces[surface_id] = surface
+
+    compiled_scene = compileRecords(records, surface_types, sphere_ids, box_ids, plane_ids, plane_objects)
+    return camera, scene_settings, surfaces, materials, lights, compiled_scene
+
+
+# Compiled scene of the record arrays. The coordinates, tables and surface types are views of the records, so records
+# loaded from the cache stay memory mapped
+def compileRecords(records, surface_types, sphere_ids, box_ids, plane_ids, plane_objects):
+    spheres = np.asarray(records['sph'])
+    boxes = np.asarray(records['box'])
+    planes = np.asarray(records['pln'])
+
+    # Same arithmetic as the Cube bounds
+    half_distances = boxes[:, 3:4] * 0.5
+    box_min = boxes[:, 0:3] - half_distances
+    box_max = boxes[:, 0:3] + half_distances
+
+    # Planes are few, their normals come from the objects so they are normalized exactly the same way
+    plane_normals = np.array([s.getNormal() for s in plane_objects], dtype=float).reshape(-1, 3)
+
+    surface_type_indices = np.empty(len(surface_types), dtype=int)
+    surface_type_indices[sphere_ids] = np.arange(len(sphere_ids))
+    surface_type_indices[box_ids] = np.arange(len(box_ids))
+    surface_type_indices[plane_ids] = np.arange(len(plane_ids))
+    surface_materials = np.empty(len(surface_types), dtype=int)
+    surface_materials[sphere_ids] = spheres[:, 4].astype(int) - 1
+    surface_materials[box_ids] = boxes[:, 4].astype(int) - 1
+    surface_materials[plane_ids] = planes[:, 4].astype(int) - 1
+
+    return CompiledScene(spheres[:, 0:3], spheres[:, 3], sphere_ids, box_min, box_max, box_ids,
+                         plane_normals, planes[:, 3], plane_ids, surface_types, surface_type_indices,
+                         surface_materials, np.asarray(records['mtl']), np.asarray(records['lgt']))
+
+
+# Hash of the contents of the scene file, names its cached records
+def hashSceneFile(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Load the records of the scene file from the cache directory, parsing and caching them if they are not there.
+# Every record type is a .npy file, memory mapped when loaded, in a directory named by the scene file hash
+def loadSceneRecords(file_path, cache_dir=None):
+    if cache_dir is None:
+        return parseSceneRecords(file_path)
+
+    scene_dir = os.path.join(cache_dir, hashSceneFile(file_path))
+    if os.path.isdir(scene_dir):
+        return {name: np.load(os.path.join(scene_dir, name + '.npy'), mmap_mode='r')
+                for name in list(RECORD_COLUMNS) + [SURFACE_ORDER]}
+
+    # Write to a temporary directory first, so a concurrent or interrupted render never sees a partial cache
+    records = parseSceneRecords(file_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=cache_dir)
+    for name, array in records.items():
+        np.save(os.path.join(temp_dir, name + '.npy'), array)
+    try:
+        os.rename(temp_dir, scene_dir)
+    except OSError:
+        # Another render cached the same scene first
+        shutil.rmtree(temp_dir)
+    return records
+
+
+# Parse (or load from the cache) and build a scene, see buildScene
+def loadScene(file_path, cache_dir=None):
+    return buildScene(loadSceneRecords(file_path, cache_dir))
@@ -1,9 +1,30 @@
 class SceneSettings:
-    def __init__(self, background_color, root_number_shadow_rays, max_recursions):
+    def __init__(self, background_color, root_number_shadow_rays, max_recursions, shadow_probes=0,
+                 shadow_tolerance=0.0, min_weight=0.0, russian_roulette=False,
+                 shadow_epsilon=0.001, light_threshold=0.0, light_samples=0):
         self.background_color = background_color
         self.root_number_shadow_rays = root_number_shadow_rays
         self.max_recursions = max_recursions
 
+        # Adaptive soft shadows: number of probe rays cast before the full grid (0 disables), and how much the
+        # probes may disagree and still be trusted
+        self.shadow_probes = shadow_probes
+        self.shadow_tolerance = shadow_tolerance
+
+        # Contribution based termination: reflection and transparency paths whose accumulated weight drops below
+        # min_weight are terminated (0 disables), or continued with russian roulette
+        self.min_weight = min_weight
+        self.russian_roulette = russian_roulette
+
+        # Shadow rays which transmit this much light or less count as fully blocked
+        self.shadow_epsilon = shadow_epsilon
+
+        # Light culling: lights whose unshadowed contribution at a hit is below light_threshold are skipped
+        # (0 disables), and only light_samples of the shadowed lights, picked at random proportionally to their
+        # contributions, cast shadow rays (0 casts them for all)
+        self.light_threshold = light_threshold
+        self.light_samples = light_samples
+
     # Get and set functions
     def getBackgroundColor(self):
         return self.background_color
@@ -14,6 +35,27 @@ class SceneSettings:
     def getMaxRecursions(self):
         return self.max_recursions
 
+    def getShadowProbes(self):
+        return self.shadow_probes
+
+    def getShadowTolerance(self):
+        return self.shadow_tolerance
+
+    def getMinWeight(self):
+        return self.min_weight
+
+    def getRussianRoulette(self):
+        return self.russian_roulette
+
+    def getShadowEpsilon(self):
+        return self.shadow_epsilon
+
+    def getLightThreshold(self):
+        return self.light_threshold
+
+    def getLightSamples(self):
+        return self.light_samples
+
     def setBackgroundColor(self, background_color):
         self.background_color = background_color
 
@@ -21,4 +63,25 @@ class SceneSettings:
         self.root_number_shadow_rays = root_number_shadow_rays
 
     def setMaxRecursions(self, max_recursions):
-        self.max_recursions = max_recursions
\ No newline at end of file
+        self.max_recursions = max_recursions
+
+    def setShadowProbes(self, shadow_probes):
+        self.shadow_probes = shadow_probes
+
+    def setShadowTolerance(self, shadow_tolerance):
+        self.shadow_tolerance = shadow_tolerance
+
+    def setMinWeight(self, min_weight):
+        self.min_weight = min_weight
+
+    def setRussianRoulette(self, russian_roulette):
+        self.russian_roulette = russian_roulette
+
+    def setShadowEpsilon(self, shadow_epsilon):
+        self.shadow_epsilon = shadow_epsilon
+
+    def setLightThreshold(self, light_threshold):
+        self.light_threshold = light_threshold
+
+    def setLightSamples(self, light_samples):
+        self.light_samples = light_samples
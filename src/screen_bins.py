@@ -0,0 +1,154 @@
+import numpy as np
+from compiled_scene import mergeClosestHits, PRIMITIVES_CHUNK
+from surfaces.cube import intersectBoxes
+from surfaces.infinite_plane import intersectPlanes
+from surfaces.sphere import intersectSpheres
+
+# Pixels added around every projected rectangle, covers rounding of the projection
+BIN_MARGIN = 1
+
+# Corners closer to the camera plane than this can not be projected, their surfaces go to every bin
+MIN_DEPTH = 1e-9
+
+# Width and height in pixels of the bins
+SCREEN_BIN_SIZE = 16
+
+# Bins whose rays times surfaces exceed this many tests are intersected with the BVH instead
+MAX_BINNED_TESTS = 1 << 19
+
+# Corners of the unit cube, to get the 8 corners of bounding boxes
+BOX_CORNERS = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=float)
+
+
+# Bins of the spheres and boxes of a compiled scene by the screen tiles their bounding boxes project to, for a fixed
+# camera and resolution. Primary rays of a tile only have to be tested against the surfaces of its bins and the
+# planes. The projection uses the same camera basis as findPixelRays
+class ScreenBins:
+    def __init__(self, camera, compiled_scene, bvh, width, height, bin_size=SCREEN_BIN_SIZE):
+        self.compiled_scene = compiled_scene
+        self.bvh = bvh
+        self.bin_size = bin_size
+        self.bins_x = -(-width // bin_size)
+        self.bins_y = -(-height // bin_size)
+
+        sphere_radii = compiled_scene.getSphereRadii()[:, np.newaxis]
+        sphere_ranges = self.findPixelRanges(camera, width, height, compiled_scene.getSphereCenters() - sphere_radii,
+                                             compiled_scene.getSphereCenters() + sphere_radii)
+        box_ranges = self.findPixelRanges(camera, width, height, compiled_scene.getBoxMin(), compiled_scene.getBoxMax())
+        self.sphere_bins = self.fillBins(sphere_ranges)
+        self.box_bins = self.fillBins(box_ranges)
+
+    # Get functions
+    def getSphereBins(self):
+        return self.sphere_bins
+
+    def getBoxBins(self):
+        return self.box_bins
+
+    # Rectangles of pixels (j0, i0, j1, i1), inclusive, which the bounding boxes (min_points, max_points) project to.
+    # Bounding boxes reaching behind the camera get the whole screen
+    def findPixelRanges(self, camera, width, height, min_points, max_points):
+        # Camera basis, like findPixelRays
+        P_0 = camera.getPosition()
+        V_to = camera.getLookAt() - P_0
+        V_to = V_to / np.linalg.norm(V_to)
+        V_up = camera.getUp() / np.linalg.norm(camera.getUp())
+        V_right = np.cross(V_up, V_to)
+        V_right = V_right / np.linalg.norm(V_right)
+        plane_V_up = np.cross(V_to, V_right)
+        plane_V_up = plane_V_up / np.linalg.norm(plane_V_up)
+        r_x = camera.getScreenWidth() / width
+        r_y = ((height / width) * camera.getScreenWidth()) / height
+
+        # Project the corners to the screen plane and to pixel coordinates
+        corners = min_points[:, np.newaxis] + BOX_CORNERS * (max_points - min_points)[:, np.newaxis]
+        vectors = corners - P_0
+        depths = vectors @ V_to
+        behind = np.any(depths < MIN_DEPTH, axis=1)
+        scales = camera.getScreenDistance() / np.where(depths < MIN_DEPTH, 1.0, depths)
+        j = (vectors @ V_right) * scales / r_x + np.floor(width / 2)
+        i = -(vectors @ plane_V_up) * scales / r_y + np.floor(height / 2)
+
+        ranges = np.stack([np.floor(j.min(axis=1)) - BIN_MARGIN, np.floor(i.min(axis=1)) - BIN_MARGIN,
+                           np.ceil(j.max(axis=1)) + BIN_MARGIN, np.ceil(i.max(axis=1)) + BIN_MARGIN], axis=1)
+        ranges[behind] = [0, 0, width - 1, height - 1]
+        return ranges
+
+    # List of the surfaces (indices in their type arrays, increasing) of every bin, from their pixel ranges
+    def fillBins(self, ranges):
+        bins = [np.zeros(0, dtype=int) for _ in range(self.bins_x * self.bins_y)]
+        bin_ranges = np.stack([np.clip(ranges[:, 0] // self.bin_size, 0, self.bins_x - 1),
+                               np.clip(ranges[:, 1] // self.bin_size, 0, self.bins_y - 1),
+                               np.clip(ranges[:, 2] // self.bin_size, 0, self.bins_x - 1),
+                               np.clip(ranges[:, 3] // self.bin_size, 0, self.bins_y - 1)], axis=1).astype(int)
+
+        # Surfaces completely off the screen are in no bin
+        on_screen = np.flatnonzero((ranges[:, 2] >= 0) & (ranges[:, 3] >= 0) &
+                                   (ranges[:, 0] < self.bins_x * self.bin_size) &
+                                   (ranges[:, 1] < self.bins_y * self.bin_size))
+        if len(on_screen) == 0:
+            return bins
+
+        # One entry per (surface, bin) it overlaps, then grouped by bin
+        bx0, by0, bx1, by1 = bin_ranges[on_screen].T
+        widths = bx1 - bx0 + 1
+        counts = widths * (by1 - by0 + 1)
+        surfaces = np.repeat(on_screen, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        bin_x = np.repeat(bx0, counts) + offsets % np.repeat(widths, counts)
+        bin_y = np.repeat(by0, counts) + offsets // np.repeat(widths, counts)
+        bin_indices = bin_y * self.bins_x + bin_x
+
+        order = np.argsort(bin_indices, kind='stable')
+        splits = np.flatnonzero(np.diff(bin_indices[order])) + 1
+        for group in np.split(order, splits):
+            bins[bin_indices[group[0]]] = surfaces[group]
+        return bins
+
+    # Closest hits of the primary rays of a tile (x0, y0, x1, y1), ordered column by column like renderTile orders
+    # them. Same results as BVH.findIntersections
+    def findIntersections(self, tile, base_points, ray_directions):
+        x0, y0, x1, y1 = tile
+        cols, rows = np.divmod(np.arange(len(ray_directions)), y1 - y0)
+        ray_bins = ((y0 + rows) // self.bin_size) * self.bins_x + (x0 + cols) // self.bin_size
+
+        intersect_t = np.empty(len(ray_directions))
+        intersect_id = np.empty(len(ray_directions), dtype=int)
+        crowded = []
+        for bin_index in np.unique(ray_bins):
+            rays = np.flatnonzero(ray_bins == bin_index)
+            if len(rays) * (len(self.sphere_bins[bin_index]) + len(self.box_bins[bin_index])) > MAX_BINNED_TESTS:
+                crowded.append(rays)
+                continue
+            intersect_t[rays], intersect_id[rays] = self.intersectBin(bin_index, base_points[rays],
+                                                                      ray_directions[rays])
+
+        # The rays of all the crowded bins go through the BVH together
+        if crowded:
+            rays = np.concatenate(crowded)
+            intersect_t[rays], intersect_id[rays] = self.bvh.findIntersections(base_points[rays],
+                                                                               ray_directions[rays])
+        return intersect_t, intersect_id
+
+    # Closest hits of rays going through one bin
+    def intersectBin(self, bin_index, base_points, ray_directions):
+        spheres = self.sphere_bins[bin_index]
+        boxes = self.box_bins[bin_index]
+        compiled_scene = self.compiled_scene
+        intersect_t = np.full(len(ray_directions), np.inf)
+        intersect_id = np.full(len(ray_directions), -1)
+        primitive_groups = [
+            (lambda a, b: intersectSpheres(compiled_scene.getSphereCenters()[spheres[a:b]],
+                                           compiled_scene.getSphereRadii()[spheres[a:b]], base_points,
+                                           ray_directions), compiled_scene.getSphereIds()[spheres]),
+            (lambda a, b: intersectBoxes(compiled_scene.getBoxMin()[boxes[a:b]], compiled_scene.getBoxMax()[boxes[a:b]],
+                                         base_points, ray_directions), compiled_scene.getBoxIds()[boxes]),
+            (lambda a, b: intersectPlanes(compiled_scene.getPlaneNormals()[a:b], compiled_scene.getPlaneOffsets()[a:b],
+                                          base_points, ray_directions), compiled_scene.getPlaneIds())
+        ]
+        for intersect, ids in primitive_groups:
+            for start in range(0, len(ids), PRIMITIVES_CHUNK):
+                end = start + PRIMITIVES_CHUNK
+                intersect_t, intersect_id = mergeClosestHits(intersect_t, intersect_id, intersect(start, end),
+                                                             ids[start:end])
+        return intersect_t, intersect_id
@@ -0,0 +1,31 @@
+import numpy as np
+from compiled_scene import MATERIAL_DIFFUSE, MATERIAL_SPECULAR, MATERIAL_SHININESS, LIGHT_POSITION, LIGHT_COLOR, \
+    LIGHT_SPECULAR_INTENSITY
+from utilities import normalizeRows
+
+
+# Phong diffuse and specular colors of every light at N hit points, like calculateSpecularAndDiffuseColor before
+# shadows. material_rows is (N, MATERIAL_COLUMNS), hit_points, normals and ray_directions are (N, 3) and the normals
+# are oriented against the rays. Returns the (N, L, 3) colors, the (N, L) mask of the lights in front of the
+# surfaces (lights behind them add nothing and their colors are zero) and the (N, L, 3) directions to the lights
+def findPhongColors(material_rows, light_table, hit_points, normals, ray_directions):
+    light_colors = light_table[:, LIGHT_COLOR]
+
+    # Directions from the hit points to the lights
+    L = normalizeRows(light_table[np.newaxis, :, LIGHT_POSITION] - hit_points[:, np.newaxis])
+    dots = np.einsum('nlk,nk->nl', L, normals)
+    lit = dots >= 0
+
+    # Calculate diffuse part
+    diffuse = light_colors * dots[:, :, np.newaxis] * material_rows[:, np.newaxis, MATERIAL_DIFFUSE]
+
+    # Calculate reflected rays and specular part
+    R = normals[:, np.newaxis] * (2 * dots)[:, :, np.newaxis] - L
+    specular = np.einsum('nlk,nk->nl', R, -ray_directions)
+    with np.errstate(invalid='ignore'):
+        specular = np.power(specular, material_rows[:, MATERIAL_SHININESS, np.newaxis])
+    specular = (specular[:, :, np.newaxis] * material_rows[:, np.newaxis, MATERIAL_SPECULAR] *
+                light_table[:, LIGHT_SPECULAR_INTENSITY, np.newaxis] * light_colors)
+
+    colors = np.where(lit[:, :, np.newaxis], diffuse + specular, 0)
+    return colors, lit, L
@@ -0,0 +1,20 @@
+# State kept between the shadow queries of one light. Shadow rays of neighboring points are coherent, so the opaque
+# surface which blocked the last shadow rays is tested first on the next ones. Rays stop as soon as the light they
+# transmit drops to epsilon
+class ShadowCache:
+    def __init__(self, epsilon=0.0):
+        self.last_occluder = -1
+        self.epsilon = epsilon
+
+    # Get and set functions
+    def getLastOccluder(self):
+        return self.last_occluder
+
+    def getEpsilon(self):
+        return self.epsilon
+
+    def setLastOccluder(self, last_occluder):
+        self.last_occluder = last_occluder
+
+    def setEpsilon(self, epsilon):
+        self.epsilon = epsilon
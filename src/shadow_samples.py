@@ -0,0 +1,37 @@
+import numpy as np
+
+# Number of differently jittered sample sets of every light, every shadow query uses one of them picked at random
+SHADOW_SAMPLE_SETS = 16
+
+# Random stream key of the sample tables, which only depend on the seed, the number of shadow rays and the lights
+SHADOW_SAMPLES_KEY = 2
+
+
+# Stratified soft shadow samples of every light: the unit square is divided into a grid of N*N cells, N being the
+# number of shadow rays, and every set has one random point in each cell. The points are offsets from the center
+# of the square, in [-0.5, 0.5). Returns a (lights, SHADOW_SAMPLE_SETS, N*N, 2) array
+def createShadowSamples(number_of_lights, shadow_rays, seed):
+    random = np.random.default_rng([seed, SHADOW_SAMPLES_KEY, shadow_rays])
+    grid = np.arange(shadow_rays)
+    cells = np.stack(np.meshgrid(grid, grid, indexing='ij'), axis=-1).reshape(-1, 2)
+    jitter = random.random((number_of_lights, SHADOW_SAMPLE_SETS, len(cells), 2))
+    return (cells + jitter) / shadow_rays - 0.5
+
+
+# Two unit vectors perpendicular to the unit vector N and to each other, as the rows of a (2, 3) array, or of a
+# (P, 2, 3) array for a (P, 3) array of unit vectors. Continuous except where N[2] changes sign, and never divides
+# by a coordinate of N that can be 0 (Duff et al., Building an Orthonormal Basis, Revisited)
+def findPerpendicularBasis(N):
+    x, y, z = N[..., 0], N[..., 1], N[..., 2]
+    sign = np.copysign(1.0, z)
+    a = -1.0 / (sign + z)
+    b = x * y * a
+    return np.stack([np.stack([1.0 + sign * x * x * a, sign * b, -sign * x], axis=-1),
+                     np.stack([b, sign + y * y * a, -y], axis=-1)], axis=-2)
+
+
+# Points on P rectangles centered at the position, whose sides are the rows of the (P, 2, 3) rectangles. offsets are
+# (S, 2) or (P, S, 2) offsets from the centers in side lengths, returns a (P, S, 3) array
+def findPointsOnRectangles(position, offsets, rectangles):
+    return (position + offsets[..., 0, np.newaxis] * rectangles[:, np.newaxis, 0] +
+            offsets[..., 1, np.newaxis] * rectangles[:, np.newaxis, 1])
@@ -1,6 +1,7 @@
 from .infinite_plane import InfinitePlane
-from utilities import normalize
+from utilities import normalize, normalizeRows
 import numpy as np
+from render_stats import stats
 
 
 class Cube:
@@ -45,6 +46,7 @@ class Cube:
     # Calculate using the slabs method
     # https://www.cs.cornell.edu/courses/cs4620/2013fa/lectures/03raytracing1.pdf
     def findIntersection(self, P_0, V):
+        stats.count('box_tests')
         inverse_direction = np.zeros(3)
         with np.errstate(divide='ignore'):
             inverse_direction = 1 / V
@@ -80,6 +82,12 @@ class Cube:
 
         return tmin
 
+    # Vectorized slabs method for N rays at once, P_0 and V are (N, 3) arrays
+    def findIntersections(self, P_0, V):
+        min_point = np.array([self.bounds_x[0], self.bounds_y[0], self.bounds_z[0]])
+        max_point = np.array([self.bounds_x[1], self.bounds_y[1], self.bounds_z[1]])
+        return intersectBoxes(min_point[np.newaxis], max_point[np.newaxis], P_0, V)[:, 0]
+
     def getNormal(self, ray):
         epsilon = 1e-6
         p = ray.getP() - self.position
@@ -99,4 +107,48 @@ class Cube:
         # Return the normal of the surface.
         normal = sign * step
         normal = normalize(normal)
-        return normal
\ No newline at end of file
+        return normal
+
+
+# Intersect N rays with M axis aligned boxes at once using the same slabs method as Cube.findIntersection.
+# min_points and max_points are (M, 3), P_0 and V are (N, 3). Returns (N, M) t values, misses are -1
+def intersectBoxes(min_points, max_points, P_0, V):
+    stats.count('box_tests', len(P_0) * len(min_points))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inverse_direction = 1 / V
+        sign = (inverse_direction < 0)[:, np.newaxis, :]
+
+        # Near and far bounds of every slab for each ray and box
+        near_bounds = np.where(sign, max_points[np.newaxis], min_points[np.newaxis])
+        far_bounds = np.where(sign, min_points[np.newaxis], max_points[np.newaxis])
+        near = (near_bounds - P_0[:, np.newaxis, :]) * inverse_direction[:, np.newaxis, :]
+        far = (far_bounds - P_0[:, np.newaxis, :]) * inverse_direction[:, np.newaxis, :]
+
+        # Find tmax and tmin
+        tmin = near[..., 0]
+        tmax = far[..., 0]
+
+        # Check y direction
+        miss = (tmin > far[..., 1]) | (near[..., 1] > tmax)
+        tmin = np.where(near[..., 1] > tmin, near[..., 1], tmin)
+        tmax = np.where(far[..., 1] < tmax, far[..., 1], tmax)
+
+        # Check z direction
+        miss |= (tmin > far[..., 2]) | (near[..., 2] > tmax)
+        tmin = np.where(near[..., 2] > tmin, near[..., 2], tmin)
+
+    return np.where(miss, -1.0, tmin)
+
+
+# Normals of N rays hitting cubes, same as Cube.getNormal which works with the base point of the ray.
+# centers, half_sizes and ray_bases are (N, 3)
+def boxNormals(centers, half_sizes, ray_bases):
+    epsilon = 1e-6
+    p = ray_bases - centers
+
+    # Sign of the vector from the center of the cube to the point, where the point is outside the cube
+    sign = np.sign(p)
+    distance = np.abs(p) - half_sizes
+    step = np.where(distance > epsilon, 1, 0)
+    return normalizeRows(sign * step)
@@ -1,4 +1,5 @@
 import numpy as np
+from render_stats import stats
 from utilities import normalize
 
 
@@ -29,12 +30,29 @@ class InfinitePlane:
 
     # Calculate intersection between the ray and the plane using algebraic method
     def findIntersection(self, P_0, vector):
+        stats.count('plane_tests')
         div = vector.dot(self.normal)
         prod = P_0.dot(self.normal) + self.offset
         with np.errstate(divide='ignore'):
             t = -(prod / div)
         return t
 
+    # Vectorized version of findIntersection for N rays at once, P_0 and vectors are (N, 3) arrays
+    def findIntersections(self, P_0, vectors):
+        return intersectPlanes(self.normal[np.newaxis], np.array([-self.offset]), P_0, vectors)[:, 0]
+
     # Get and set functions
     def getNormal(self, ray=None):
         return self.normal
+
+
+# Intersect N rays with M planes at once using the same algebraic method as InfinitePlane.findIntersection.
+# normals is (M, 3), offsets is (M,) holding the scene file offsets, P_0 and vectors are (N, 3). Returns (N, M) t values
+def intersectPlanes(normals, offsets, P_0, vectors):
+    stats.count('plane_tests', len(P_0) * len(normals))
+
+    div = vectors.dot(normals.T)
+    prod = P_0.dot(normals.T) - offsets
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -(prod / div)
+    return t
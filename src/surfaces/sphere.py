@@ -1,5 +1,6 @@
 import numpy as np
-from utilities import normalize
+from render_stats import stats
+from utilities import normalize, normalizeRows
 
 
 class Sphere:
@@ -29,6 +30,8 @@ class Sphere:
 
     # Calculate intersection between the ray and the sphere using geometric method we learnt in the lecture
     def findIntersection(self, P_0, V):
+        stats.count('sphere_tests')
+
         # Calculate L and T_ca
         L = self.position - P_0
         T_ca = np.dot(L, V)
@@ -56,8 +59,42 @@ class Sphere:
             t1 = t2
         return t1
 
+    # Vectorized version of findIntersection for N rays at once, P_0 and V are (N, 3) arrays
+    def findIntersections(self, P_0, V):
+        return intersectSpheres(self.position[np.newaxis], np.array([self.radius]), P_0, V)[:, 0]
+
     # Gives the normal of point on the sphere
     def getNormal(self, ray):
         V = ray.getIntersectionPoint()
         normal = V - self.position
         return normalize(normal)
+
+
+# Intersect N rays with M spheres at once using the same geometric method as Sphere.findIntersection.
+# centers is (M, 3), radii is (M,), P_0 and V are (N, 3). Returns (N, M) t values, misses are zero
+def intersectSpheres(centers, radii, P_0, V):
+    stats.count('sphere_tests', len(P_0) * len(centers))
+
+    # Calculate L and T_ca for every ray and sphere
+    L = centers[np.newaxis, :, :] - P_0[:, np.newaxis, :]
+    T_ca = np.einsum('nmk,nk->nm', L, V)
+
+    # Calculate d^2
+    d_squared = np.einsum('nmk,nmk->nm', L, L) - (T_ca * T_ca)
+    radii_squared = radii * radii
+
+    # Calculate T_hc (rays which miss the sphere get nan and are masked below)
+    with np.errstate(invalid='ignore'):
+        T_hc = np.sqrt(radii_squared - d_squared)
+    t1 = T_ca - T_hc
+    t2 = T_ca + T_hc
+
+    # Same miss conditions as the single ray version, misses return zero
+    miss = (T_ca < 0) | (d_squared > radii_squared) | ((t1 <= 0) & (t2 <= 0))
+    t = np.where(t1 < 0, t2, t1)
+    return np.where(miss, 0.0, t)
+
+
+# Normals of N points on spheres, centers and hit_points are (N, 3)
+def sphereNormals(centers, hit_points):
+    return normalizeRows(hit_points - centers)
@@ -0,0 +1,397 @@
+import multiprocessing
+import queue
+import time
+import numpy as np
+from color_finder import ColorFinder
+from ray import Ray
+from cost_map import COST_RAYS, COST_SECONDS
+from gbuffer import createGBuffer
+from render_stats import stats
+from utilities import findPixelRays, normalizeRows
+from wavefront import shadeWavefront
+
+# Number of primary rays intersected together in one batch
+PRIMARY_RAYS_CHUNK = 65536
+
+# Number of tiles given to every worker of a pool at a time, one being rendered and one waiting so it never idles
+TILES_PER_WORKER = 2
+
+
+# Everything needed to render any tile of the image. It is shipped once to every worker process
+class RenderContext:
+    def __init__(self, camera, scene_settings, surfaces, materials, lights, compiled_scene, bvh, softshadow_func,
+                 width, height, seed=42):
+        self.camera = camera
+        self.scene_settings = scene_settings
+        self.surfaces = surfaces
+        self.materials = materials
+        self.lights = lights
+        self.compiled_scene = compiled_scene
+        self.bvh = bvh
+        self.softshadow_func = softshadow_func
+        self.width = width
+        self.height = height
+        self.seed = seed
+
+        # Shade with the breadth first wavefront instead of recursing pixel by pixel
+        self.wavefront = False
+
+        # Record the number of rays and shading time of every pixel
+        self.cost_map = False
+
+        # Record the G-buffer of every tile
+        self.record_gbuffer = False
+
+        # Screen space bins of the surfaces, primary rays are intersected with them instead of the BVH if set
+        self.screen_bins = None
+
+        # Relight: the primary hits come from the G-buffer of a previous render, and only the pixels of the relight
+        # mask are shaded, the rest keep their G-buffer color
+        self.relight_gbuffer = None
+        self.relight_pixels = None
+
+        # Crop: only the window (x0, y0, x1, y1) of the width by height frame is rendered, as an image of its size
+        self.crop = None
+
+    # Get and set functions
+    def getCamera(self):
+        return self.camera
+
+    def getSceneSettings(self):
+        return self.scene_settings
+
+    def getSurfaces(self):
+        return self.surfaces
+
+    def getMaterials(self):
+        return self.materials
+
+    def getLights(self):
+        return self.lights
+
+    def getCompiledScene(self):
+        return self.compiled_scene
+
+    def getBVH(self):
+        return self.bvh
+
+    def getSoftshadowFunc(self):
+        return self.softshadow_func
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def getSeed(self):
+        return self.seed
+
+    def getWavefront(self):
+        return self.wavefront
+
+    def getCostMap(self):
+        return self.cost_map
+
+    def getRecordGBuffer(self):
+        return self.record_gbuffer
+
+    def getScreenBins(self):
+        return self.screen_bins
+
+    def getRelightGBuffer(self):
+        return self.relight_gbuffer
+
+    def getRelightPixels(self):
+        return self.relight_pixels
+
+    def getCrop(self):
+        return self.crop
+
+    # The rendered window of the frame, the crop or the whole frame
+    def getWindow(self):
+        return self.crop if self.crop is not None else (0, 0, self.width, self.height)
+
+    def setCamera(self, camera):
+        self.camera = camera
+
+    def setSceneSettings(self, scene_settings):
+        self.scene_settings = scene_settings
+
+    def setWidth(self, width):
+        self.width = width
+
+    def setHeight(self, height):
+        self.height = height
+
+    def setWavefront(self, wavefront):
+        self.wavefront = wavefront
+
+    def setCostMap(self, cost_map):
+        self.cost_map = cost_map
+
+    def setRecordGBuffer(self, record_gbuffer):
+        self.record_gbuffer = record_gbuffer
+
+    def setScreenBins(self, screen_bins):
+        self.screen_bins = screen_bins
+
+    def setRelight(self, relight_gbuffer, relight_pixels):
+        self.relight_gbuffer = relight_gbuffer
+        self.relight_pixels = relight_pixels
+
+    def setCrop(self, crop):
+        self.crop = crop
+
+    def createColorFinder(self):
+        return ColorFinder(self.scene_settings, self.lights, self.bvh, self.materials,
+                           self.scene_settings.getBackgroundColor(), self.softshadow_func, self.seed)
+
+
+# Split the image into tiles (x0, y0, x1, y1), row by row
+def splitTiles(width, height, tile_size):
+    tiles = []
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            tiles.append((x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height)))
+    return tiles
+
+
+# Render the pixels of one tile, returns a (y1 - y0, x1 - x0, 3) array of colors in [0, 255], if the context
+# records a cost map a (y1 - y0, x1 - x0, 2) array of the rays spawned and seconds spent shading every pixel, and if
+# it records G-buffers the G-buffer of the tile (None otherwise)
+def renderTile(context, color_finder, tile):
+    x0, y0, x1, y1 = tile
+    tile_width = x1 - x0
+    tile_height = y1 - y0
+    camera = context.getCamera()
+    scene_settings = context.getSceneSettings()
+    materials = context.getMaterials()
+    surfaces = context.getSurfaces()
+
+    # Find the rays mapped to each pixel of the tile
+    _, rays_directions = findPixelRays(camera, context.getWidth(), context.getHeight(), tile)
+
+    # Flatten the rays in the same column by column order the pixels are colored in
+    directions = normalizeRows(rays_directions.transpose(1, 0, 2).reshape(-1, 3))
+    P_0 = camera.getPosition()
+    base_points = np.broadcast_to(P_0, directions.shape)
+
+    relight_gbuffer = context.getRelightGBuffer()
+    if relight_gbuffer is None:
+        # Find the nearest intersection of all primary rays at once, a large chunk of rays at a time.
+        # With screen bins, the rays of every bin are only tested with the surfaces projecting to it
+        t_values = np.empty(len(directions))
+        surface_indices = np.empty(len(directions), dtype=int)
+        with stats.measure('primary_intersection'):
+            if context.getScreenBins() is not None:
+                t_values, surface_indices = context.getScreenBins().findIntersections(tile, base_points, directions)
+            else:
+                for start in range(0, len(directions), PRIMARY_RAYS_CHUNK):
+                    end = start + PRIMARY_RAYS_CHUNK
+                    t_values[start:end], surface_indices[start:end] = context.getBVH().findIntersections(
+                        base_points[start:end], directions[start:end])
+
+        # Default color if no intersection
+        tile_array = np.zeros((tile_height, tile_width, 3))
+        tile_array[:, :] = scene_settings.getBackgroundColor() * 255.0
+    else:
+        # Primary hits of the previous render (in the same column by column order), which keep its colors
+        t_values = relight_gbuffer.getTValues()[y0:y1, x0:x1].T.reshape(-1)
+        surface_indices = relight_gbuffer.getSurfaceIds()[y0:y1, x0:x1].T.reshape(-1)
+        tile_array = relight_gbuffer.getColors()[y0:y1, x0:x1].copy()
+
+    # Every pixel casts its primary ray (unless relighting), the rest of its cost is added while it is shaded
+    tile_cost = None
+    if context.getCostMap():
+        tile_cost = np.zeros((tile_height, tile_width, 2))
+        tile_cost[:, :, COST_RAYS] = 1 if relight_gbuffer is None else 0
+
+    # Their is intersection? calculate color
+    hits = np.flatnonzero(surface_indices >= 0)
+    if relight_gbuffer is None:
+        stats.count('primary_rays', len(directions))
+        stats.count('primary_hits', len(hits))
+    else:
+        hits = hits[context.getRelightPixels()[y0:y1, x0:x1].T.reshape(-1)[hits]]
+    hit_cols, hit_rows = np.divmod(hits, tile_height)
+
+    # Primary hits of the G-buffer, the materials of the paths are added while shading
+    tile_gbuffer = None
+    if context.getRecordGBuffer():
+        if relight_gbuffer is None:
+            tile_gbuffer = createGBuffer(tile_width, tile_height, len(materials))
+        else:
+            tile_gbuffer = relight_gbuffer.getTile(tile)
+        tile_gbuffer.recordHits(hit_rows, hit_cols, context.getCompiledScene(), base_points[hits], directions[hits],
+                                t_values[hits], surface_indices[hits])
+
+    if context.getWavefront():
+        hit_costs = np.zeros((len(hits), 2)) if tile_cost is not None else None
+        hit_masks = np.zeros((len(hits), len(materials)), dtype=bool) if tile_gbuffer is not None else None
+        colors = shadeWavefront(context, color_finder, y0 + hit_rows, x0 + hit_cols, base_points[hits],
+                                directions[hits], t_values[hits], surface_indices[hits], hit_costs, hit_masks)
+        tile_array[hit_rows, hit_cols, :] = colors * 255.0
+        if tile_cost is not None:
+            tile_cost[hit_rows, hit_cols] += hit_costs
+        if tile_gbuffer is not None:
+            tile_gbuffer.getMaterialMasks()[hit_rows, hit_cols] |= hit_masks
+            tile_gbuffer.getColors()[:] = tile_array
+        return tile_array, tile_cost, tile_gbuffer
+
+    surface_materials = context.getCompiledScene().getSurfaceMaterials()
+    for ray_index, row, col in zip(hits, hit_rows, hit_cols):
+        t = t_values[ray_index]
+        direction = directions[ray_index]
+        surface = surfaces[surface_indices[ray_index]]
+        material_index = surface_materials[surface_indices[ray_index]]
+        ray = Ray(P_0, direction, P_0 + t * direction)
+        color_finder.seedPixel(y0 + row, x0 + col)
+        color_finder.resetPathMaterials()
+        rays_before = stats.countRays()
+        start_time = time.perf_counter()
+        color = color_finder.calculateColor(ray, materials[material_index], surface,
+                                            scene_settings.getMaxRecursions())
+        if tile_cost is not None:
+            tile_cost[row, col, COST_SECONDS] = time.perf_counter() - start_time
+            tile_cost[row, col, COST_RAYS] += stats.countRays() - rays_before
+        if tile_gbuffer is not None:
+            tile_gbuffer.getMaterialMasks()[row, col, list(color_finder.getPathMaterials())] = True
+
+        tile_array[row, col, :] = (color[:] * 255.0)
+
+    if tile_gbuffer is not None:
+        tile_gbuffer.getColors()[:] = tile_array
+    return tile_array, tile_cost, tile_gbuffer
+
+
+# State of a worker process, set once by the pool initializer
+worker_context = None
+worker_color_finder = None
+
+
+def initWorker(context):
+    global worker_context, worker_color_finder
+    worker_context = context
+    worker_color_finder = context.createColorFinder()
+
+    # Forked workers start with a copy of the parent's stats, they must not be counted twice
+    stats.collect()
+
+
+# Render a tile (x0, y0, x1, y1) of the image, which is the tile of the frame offset by the window the image covers.
+# Pixels keep their frame coordinates, so a cropped image has the same pixels as the whole frame
+def renderImageTile(context, color_finder, tile):
+    window_x, window_y, _, _ = context.getWindow()
+    x0, y0, x1, y1 = tile
+    return renderTile(context, color_finder, (window_x + x0, window_y + y0, window_x + x1, window_y + y1))
+
+
+# Render a tile of the image in a worker, the stats of the tile go back with it
+def renderWorkerTile(tile):
+    tile_array, tile_cost, tile_gbuffer = renderImageTile(worker_context, worker_color_finder, tile)
+    return tile, tile_array, tile_cost, tile_gbuffer, stats.collect()
+
+
+# Render the whole image tile by tile, in a pool of worker processes if workers > 1.
+# The image is the same for any number of workers and any tile size because every pixel seeds its own randomness.
+# With a crop the image only covers the crop window, and the tiles of the framebuffer, checkpoint and G-buffer are
+# tiles of the image. Returns the image and its cost map (None unless the context records one). If a framebuffer is given the tiles
+# are added to it as they finish instead, and no image is returned. If a checkpoint is given, only the tiles it has
+# not finished are rendered, and every rendered tile is added to it. If the context records G-buffers, the G-buffer of
+# every tile is set in gbuffer. If a deadline (a time.perf_counter() value) is given and passes before the last tile is
+# finished, the render stops (the workers are terminated without finishing their tiles) and returns no image and cost
+# map. A render whose last tile finishes after the deadline is still returned
+def renderImage(context, workers=1, tile_size=64, framebuffer=None, checkpoint=None, gbuffer=None, deadline=None):
+    window_x0, window_y0, window_x1, window_y1 = context.getWindow()
+    width = window_x1 - window_x0
+    height = window_y1 - window_y0
+    image_array = None
+    if framebuffer is None:
+        image_array = np.zeros((height, width, 3))
+    cost_array = np.zeros((height, width, 2)) if context.getCostMap() else None
+    tiles = splitTiles(width, height, tile_size)
+
+    # Put a tile in the framebuffer if there is one, else in the image, and its cost in the cost map
+    def storeTile(tile, tile_array, tile_cost):
+        x0, y0, x1, y1 = tile
+        if framebuffer is not None:
+            framebuffer.addTile(tile, tile_array)
+        else:
+            image_array[y0:y1, x0:x1] = tile_array
+        if cost_array is not None and tile_cost is not None:
+            cost_array[y0:y1, x0:x1] = tile_cost
+
+    # Tiles finished before are restored (they have no cost), the rest are rendered and checkpointed
+    if checkpoint is not None:
+        for tile in checkpoint.getFinishedTiles():
+            storeTile(tile, checkpoint.getTile(tile), None)
+        tiles = checkpoint.getUnfinishedTiles()
+
+    def finishTile(tile, tile_array, tile_cost, tile_gbuffer):
+        if checkpoint is not None:
+            checkpoint.addTile(tile, tile_array)
+        if gbuffer is not None:
+            gbuffer.setTile(tile, tile_gbuffer)
+        storeTile(tile, tile_array, tile_cost)
+
+    try:
+        if workers <= 1:
+            color_finder = context.createColorFinder()
+            for tile in tiles:
+                if deadline is not None and time.perf_counter() > deadline:
+                    return None, None
+                finishTile(tile, *renderImageTile(context, color_finder, tile))
+            return image_array, cost_array
+
+        # A streaming framebuffer keeps every band in memory until the bands before it are written, so with one no tile
+        # more than a band per worker after the oldest unfinished tile is given. One slow tile then stalls the other
+        # workers instead of letting them fill the memory with later bands
+        tiles = list(tiles)
+        max_ahead = len(tiles)
+        if framebuffer is not None:
+            max_ahead = workers * framebuffer.getTilesPerBand()
+
+        with multiprocessing.Pool(workers, initializer=initWorker, initargs=(context,)) as pool:
+            # Every worker has TILES_PER_WORKER tiles in flight and is given its next tile when it finishes one, and
+            # like with a single worker no tile is given after the deadline. Once all the tiles are given the render
+            # is finished, before that it stops at the deadline without waiting for the tiles in flight
+            finished = queue.Queue()
+            indices = {tile: index for index, tile in enumerate(tiles)}
+            done = np.zeros(len(tiles), dtype=bool)
+            oldest = 0
+            given = 0
+            in_flight = 0
+            for _ in range(len(tiles)):
+                while (given < len(tiles) and in_flight < workers * TILES_PER_WORKER
+                       and given < oldest + max_ahead):
+                    if deadline is not None and time.perf_counter() > deadline:
+                        pool.terminate()
+                        return None, None
+                    pool.apply_async(renderWorkerTile, (tiles[given],), callback=finished.put,
+                                     error_callback=finished.put)
+                    given += 1
+                    in_flight += 1
+
+                try:
+                    waiting = deadline is not None and given < len(tiles)
+                    result = finished.get(timeout=max(deadline - time.perf_counter(), 0) if waiting else None)
+                except queue.Empty:
+                    pool.terminate()
+                    return None, None
+                if isinstance(result, BaseException):
+                    raise result
+                tile, tile_array, tile_cost, tile_gbuffer, tile_stats = result
+                finishTile(tile, tile_array, tile_cost, tile_gbuffer)
+                stats.merge(tile_stats)
+
+                in_flight -= 1
+                done[indices[tile]] = True
+                while oldest < len(tiles) and done[oldest]:
+                    oldest += 1
+    finally:
+        # Even if the render is interrupted, the tiles finished so far are kept
+        if checkpoint is not None:
+            checkpoint.flush()
+
+    return image_array, cost_array
@@ -1,9 +1,12 @@
 import numpy as np
 from ray import *
+from render_stats import timed
 
 
-# Finds pixel to ray mapping using what we learnt in the lecture
-def findPixelRays(camera, R_x, R_y):
+# Finds pixel to ray mapping using what we learnt in the lecture.
+# window = (x0, y0, x1, y1) limits the mapping to the pixels of that window of the screen
+@timed('findPixelRays')
+def findPixelRays(camera, R_x, R_y, window=None):
     # Look direction vector
     V_to = camera.getLookAt() - camera.getPosition()
     V_to = V_to / np.linalg.norm(V_to)
@@ -30,13 +33,14 @@ def findPixelRays(camera, R_x, R_y):
     screen_height = (R_y / R_x) * screen_width
     r_y = screen_height / R_y
 
-    # Find each screen pixel coordinates
-    i_matrix = np.tile(np.arange(R_y), (R_x, 1)).T
-    j_matrix = np.tile(np.arange(R_x), (R_y, 1))
+    # Find each screen pixel coordinates (of the whole screen by default)
+    x0, y0, x1, y1 = window if window is not None else (0, 0, R_x, R_y)
+    i_matrix = np.tile(np.arange(y0, y1), (x1 - x0, 1)).T
+    j_matrix = np.tile(np.arange(x0, x1), (y1 - y0, 1))
     x = r_x * (j_matrix - np.floor(R_x / 2))
     y = r_y * (i_matrix - np.floor(R_y / 2))
     P = P_c + (x.reshape(-1, 1) * V_right) - (y.reshape(-1, 1) * plane_V_up)
-    P = P.reshape(R_y, R_x, 3)
+    P = P.reshape(y1 - y0, x1 - x0, 3)
 
     # Calculate the subtraction of each vector in the matrix with P_0
     P_sub = P - P_0
@@ -45,6 +49,10 @@ def findPixelRays(camera, R_x, R_y):
 
 # Tries to find minimum intersection point with one of the surfaces
 def findIntersection(base_point, ray_direction, surfaces):
+    # Acceleration structure (BVH) instead of list? let it answer the query
+    if not isinstance(surfaces, list):
+        return surfaces.findIntersection(base_point, ray_direction)
+
     intersect_t = np.inf
     intersect_surface = None
 
@@ -63,36 +71,64 @@ def findIntersection(base_point, ray_direction, surfaces):
     return intersect_t, intersect_surface
 
 
-# Find transparency factor
-def findTransparencyFactor(base_point, ray_direction, distance, surfaces, materials):
-    transparency_factor = 1.0
+# Batched version of findIntersection, base_points and ray_directions are (N, 3) arrays.
+# Returns the minimum t of every ray (np.inf if not found) and the index of the intersected surface (-1 if not found)
+def findIntersections(base_points, ray_directions, surfaces):
+    if not isinstance(surfaces, list):
+        return surfaces.findIntersections(base_points, ray_directions)
 
-    # Look for intersection with surface
+    intersect_t = np.full(len(ray_directions), np.inf)
+    intersect_index = np.full(len(ray_directions), -1)
+
+    # Look for intersection with surface, a whole batch of rays at a time
+    for index, surface in enumerate(surfaces):
+        t = surface.findIntersections(base_points, ray_directions)
+
+        # Found closer intersection points?
+        closer = (t > 0) & (t < intersect_t)
+        intersect_t[closer] = t[closer]
+        intersect_index[closer] = index
+
+    return intersect_t, intersect_index
+
+
+# Product of the transparencies of the surfaces blocking every shadow ray before its distance, base_points and
+# ray_directions are (N, 3) arrays and distances is (N,)
+# shadow_cache (a ShadowCache of the light) is used by acceleration structures
+def findTransparencyFactors(base_points, ray_directions, distances, surfaces, materials, shadow_cache=None):
+    if not isinstance(surfaces, list):
+        return surfaces.findTransparencyFactors(base_points, ray_directions, distances, shadow_cache)
+
+    transparency_factors = np.ones(len(ray_directions))
+
+    # Look for intersection with surface, a whole batch of rays at a time
     for surface in surfaces:
-        t = surface.findIntersection(base_point, ray_direction)
+        t = surface.findIntersections(base_points, ray_directions)
 
-        # Found intersection point? Mul with the transparency factor
-        if 0 < t < distance:
-            material = materials[surface.getMaterial() - 1]
-            transparency_factor *= material.getTransparency()
+        # Found intersection points? Mul with the transparency factor
+        blocked = (t > 0) & (t < distances)
+        transparency_factors[blocked] *= materials[surface.getMaterial() - 1].getTransparency()
 
-    return transparency_factor
+    return transparency_factors
 
 
-# Has intersection
-def hasIntersection(base_point, ray_direction, distance, surfaces, materials):
-    no_intersection_flag = 1.0
+# Returns 1.0 for shadow rays which reach their distance and 0.0 for blocked rays
+def hasIntersections(base_points, ray_directions, distances, surfaces, materials, shadow_cache=None):
+    if not isinstance(surfaces, list):
+        return surfaces.hasIntersections(base_points, ray_directions, distances, shadow_cache)
 
-    # Look for intersection with surface
+    no_intersection_flags = np.ones(len(ray_directions))
+
+    # Look for intersection with surface, a whole batch of rays at a time
     for surface in surfaces:
-        t = surface.findIntersection(base_point, ray_direction)
+        t = surface.findIntersections(base_points, ray_directions)
+        no_intersection_flags[(t > 0) & (t < distances)] = 0.0
 
-        # Found intersection point? Mul with the transparency factor
-        if 0 < t < distance:
-            no_intersection_flag = 0.0
+        # All rays blocked? no need to look further
+        if not np.any(no_intersection_flags):
             break
 
-    return no_intersection_flag
+    return no_intersection_flags
 
 
 def calculateReflectionDirection(I, N):
@@ -105,6 +141,13 @@ def calculateReflectionDirection(I, N):
     return R
 
 
+# Normalize each row of (N, 3) array of vectors, zero rows stay zero
+def normalizeRows(V):
+    norms = np.linalg.norm(V, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return V / norms
+
+
 # Safe normalize
 def normalize(V):
     if np.all(V == 0):
@@ -0,0 +1,216 @@
+import time
+import numpy as np
+from cost_map import COST_RAYS, COST_SECONDS
+from counter_random import TRANSPARENCY_PATH, REFLECTION_PATH, ROULETTE_STREAM, counterRandom
+from color_finder import combineColors
+from compiled_scene import MATERIAL_REFLECTION, MATERIAL_TRANSPARENCY
+from render_stats import stats
+from utilities import normalizeRows
+
+# Child indices of rays which were not traced or missed (background color), and of terminated paths
+NO_CHILD = -1
+TERMINATED_CHILD = -2
+
+
+# The rays of one bounce depth of the wavefront, with the pixel and path each of them came from, their accumulated
+# weight and the primary hit they belong to. After shading, holds the local (phong) color and the material of every
+# hit, where its children went and the factors their colors are scaled by (russian roulette survivors, 1 for the
+# other children)
+class WavefrontLevel:
+    def __init__(self, rows, cols, paths, ray_bases, ray_directions, t_values, surface_ids, weights, pixels):
+        self.rows = rows
+        self.cols = cols
+        self.paths = paths
+        self.pixels = pixels
+        self.weights = weights
+        self.ray_bases = ray_bases
+        self.ray_directions = ray_directions
+        self.t_values = t_values
+        self.surface_ids = surface_ids
+        self.hit_points = ray_bases + t_values[:, np.newaxis] * ray_directions
+        self.normals = None
+        self.local_colors = None
+        self.transparency = None
+        self.reflection_colors = None
+        self.transparency_children = np.full(len(rows), NO_CHILD)
+        self.reflection_children = np.full(len(rows), NO_CHILD)
+        self.transparency_scales = np.ones(len(rows))
+        self.reflection_scales = np.ones(len(rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+
+# Calculate the colors of N primary hits like ColorFinder.calculateColor, but breadth first: at every bounce depth
+# the transparency and reflection rays of all the hits are intersected together as one batch. The recursion clips
+# the color at every level (see combineColors), so the colors are resolved bottom up from the deepest level once all
+# rays are traced.
+# rows and cols are (N,) pixel coordinates, ray_bases and ray_directions are (N, 3), t_values and surface_ids (N,).
+# If costs, an (N, 2) array, is given, the rays spawned and seconds spent shading every hit are added to it.
+# If material_masks, an (N, materials) bool array, is given, the materials hit by the paths of every hit are set in it
+def shadeWavefront(context, color_finder, rows, cols, ray_bases, ray_directions, t_values, surface_ids,
+                   costs=None, material_masks=None):
+    scene_settings = context.getSceneSettings()
+    background_color = scene_settings.getBackgroundColor()
+    max_recursions = scene_settings.getMaxRecursions()
+
+    # Passed the limit of recursion?
+    if max_recursions == 0:
+        return np.tile(background_color, (len(rows), 1))
+
+    # Trace the levels one bounce depth at a time
+    count = len(rows)
+    levels = [WavefrontLevel(rows, cols, np.zeros(count, dtype=np.int64), ray_bases, ray_directions, t_values,
+                             surface_ids, np.ones(count), np.arange(count))]
+    for depth in range(max_recursions):
+        level = levels[-1]
+        shadeLevel(context, color_finder, level, depth, costs, material_masks)
+
+        # Children of the last allowed depth return the background color, no need to trace them
+        if depth + 1 == max_recursions:
+            break
+        next_level = spawnChildren(context, color_finder, level, depth, costs)
+        if len(next_level) == 0:
+            break
+        levels.append(next_level)
+
+    # Resolve the colors from the deepest level up
+    colors = None
+    excess = None
+    child_level = None
+    for level in reversed(levels):
+        colors, excess = resolveLevel(level, child_level, colors, excess, background_color,
+                                      color_finder.getTerminatedColor())
+        child_level = level
+    return np.clip(colors + excess, 0, 1)
+
+
+# Calculate normals, materials and color caused by specular and diffuse of every hit of the level
+def shadeLevel(context, color_finder, level, depth, costs=None, material_masks=None):
+    compiled_scene = context.getCompiledScene()
+
+    # Get normals, needs the opposite direction of normal?
+    normals = compiled_scene.findNormals(level.surface_ids, level.ray_bases, level.hit_points)
+    facing = np.einsum('ij,ij->i', normals, level.ray_directions) > 0
+    normals[facing] = -normals[facing]
+    level.normals = normalizeRows(normals)
+
+    # Materials of the hits
+    material_indices = compiled_scene.getSurfaceMaterials()[level.surface_ids]
+    material_rows = compiled_scene.getMaterialTable()[material_indices]
+    if material_masks is not None:
+        material_masks[level.pixels, material_indices] = True
+    level.transparency = material_rows[:, MATERIAL_TRANSPARENCY]
+    level.reflection_colors = material_rows[:, MATERIAL_REFLECTION]
+
+    # Calculate color caused by specular and diffuse, the phong colors and the shadow rays of all the hits at once.
+    # The shading time is shared by the hits in proportion to the rays they spawned
+    start_time = time.perf_counter()
+    phong = color_finder.findPhongColors(material_indices, level.hit_points, level.normals, level.ray_directions)
+    path_keys = color_finder.findPathKeys(level.rows, level.cols, depth, level.paths)
+    level.local_colors, shadow_rays = color_finder.findSpecularAndDiffuseColors(phong, level.hit_points, path_keys)
+    if costs is not None:
+        rays = np.sum(shadow_rays)
+        shares = shadow_rays / rays if rays > 0 else np.full(len(level), 1.0 / len(level))
+        np.add.at(costs[:, COST_RAYS], level.pixels, shadow_rays)
+        np.add.at(costs[:, COST_SECONDS], level.pixels, (time.perf_counter() - start_time) * shares)
+
+
+# Cast the transparency and reflection rays of a shaded level as one batch, returns the level of the rays that hit
+def spawnChildren(context, color_finder, level, depth, costs=None):
+    black_spots_factor = color_finder.black_spots_factor
+    transparent = np.flatnonzero(level.transparency > 0)
+    reflective = np.flatnonzero(np.any(level.reflection_colors != 0, axis=1))
+
+    # Transparency rays continue in the same direction
+    transparency_directions = level.ray_directions[transparent]
+
+    # Reflection rays, R = I - 2 (N . I) N
+    I = level.ray_directions[reflective]
+    N = level.normals[reflective]
+    reflection_directions = normalizeRows(I - (2 * np.einsum('ij,ij->i', N, I))[:, np.newaxis] * N)
+
+    # Accumulated weights of the children
+    parents = np.concatenate([transparent, reflective])
+    is_transparency = np.arange(len(parents)) < len(transparent)
+    weights = level.weights[parents] * np.concatenate([level.transparency[transparent],
+                                                       np.max(level.reflection_colors[reflective], axis=1)])
+    paths = level.paths[parents] * 3 + np.where(is_transparency, TRANSPARENCY_PATH, REFLECTION_PATH)
+
+    # Paths which contribute too little are terminated (or go through russian roulette), with the roulette random
+    # numbers of all the children drawn at once
+    path_keys = color_finder.findPathKeys(level.rows[parents], level.cols[parents], depth + 1, paths)
+    scales = color_finder.findPathSurvivals(weights, counterRandom(path_keys, ROULETTE_STREAM))
+    terminated = scales == 0
+    level.transparency_scales[parents[is_transparency & ~terminated]] = scales[is_transparency & ~terminated]
+    level.reflection_scales[parents[~is_transparency & ~terminated]] = scales[~is_transparency & ~terminated]
+    level.transparency_children[parents[terminated & is_transparency]] = TERMINATED_CHILD
+    level.reflection_children[parents[terminated & ~is_transparency]] = TERMINATED_CHILD
+    traced = np.flatnonzero(~terminated)
+    parents = parents[traced]
+    is_transparency = is_transparency[traced]
+
+    # Points where rays start (0.0002 prevents black spots)
+    ray_directions = np.concatenate([transparency_directions, reflection_directions])[traced]
+    ray_bases = level.hit_points[parents] + black_spots_factor * ray_directions
+
+    # Find intersection of all the rays together
+    t_values, surface_ids = context.getBVH().findIntersections(ray_bases, ray_directions)
+    hits = np.flatnonzero(surface_ids >= 0)
+    stats.count('transparency_rays', int(np.count_nonzero(is_transparency)))
+    stats.count('reflection_rays', int(np.count_nonzero(~is_transparency)))
+    stats.count('transparency_hits', int(np.count_nonzero(is_transparency[hits])))
+    stats.count('reflection_hits', int(np.count_nonzero(~is_transparency[hits])))
+    if costs is not None:
+        np.add.at(costs[:, COST_RAYS], level.pixels[parents], 1)
+
+    # Remember where the children that hit went, survivors carry their scaled weight
+    children = np.arange(len(hits))
+    hit_parents = parents[hits]
+    hit_transparency = is_transparency[hits]
+    level.transparency_children[hit_parents[hit_transparency]] = children[hit_transparency]
+    level.reflection_children[hit_parents[~hit_transparency]] = children[~hit_transparency]
+
+    hits_traced = traced[hits]
+    return WavefrontLevel(level.rows[hit_parents], level.cols[hit_parents], paths[hits_traced], ray_bases[hits],
+                          ray_directions[hits], t_values[hits], surface_ids[hits],
+                          weights[hits_traced] * scales[hits_traced],
+                          level.pixels[hit_parents])
+
+
+# Combine the local colors of a level with the colors and russian roulette excess of its children (the level after
+# it), the same way calculateColor does. Returns the colors and the excess of the level
+def resolveLevel(level, child_level, child_colors, child_excess, background_color, terminated_color):
+    count = len(level)
+
+    # Children which missed (or were not traced) get the background color, terminated ones the terminated color.
+    # Only the children which hit have an excess
+    def childColors(children):
+        colors = np.tile(background_color, (count, 1)).astype(float)
+        excess = np.zeros((count, 3))
+        traced = children >= 0
+        if child_level is not None:
+            colors[traced] = child_colors[children[traced]]
+            excess[traced] = child_excess[children[traced]]
+        colors[children == TERMINATED_CHILD] = terminated_color
+        return colors, excess
+
+    # Calculate color caused by transparency
+    transparency = level.transparency[:, np.newaxis]
+    transparency_colors, transparency_excess = childColors(level.transparency_children)
+    transparency_colors = np.clip(transparency_colors, 0, 1)
+    transparency_colors[level.transparency <= 0] = 0
+    transparency_excess[level.transparency <= 0] = 0
+
+    # Calculate color caused by reflectance
+    reflection_child_colors, reflection_child_excess = childColors(level.reflection_children)
+    reflectance_colors = np.clip(reflection_child_colors * level.reflection_colors, 0, 1)
+    reflectance_excess = reflection_child_excess * level.reflection_colors
+    reflective = np.any(level.reflection_colors != 0, axis=1)
+    reflectance_colors[~reflective] = 0
+    reflectance_excess[~reflective] = 0
+
+    # Calculate color of surface, prevent overflow
+    return combineColors(level.local_colors, transparency, transparency_colors, transparency_excess,
+                         level.transparency_scales[:, np.newaxis], reflectance_colors, reflectance_excess,
+                         level.reflection_scales[:, np.newaxis])